@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Compares the serial and the threaded extraction of dmgzipext on a synthetic pack.
+
+    python benchmarks/extract.py [entries] [threads]
+"""
+import hashlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from polymath import dmgzipext
+
+
+def synthetic_pack(entries):
+    rng = random.Random(0)
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zipf:
+        for i in range(entries):
+            # half random half repeated, so it compresses like a texture would
+            size = rng.randrange(4096, 65536)
+            data = bytes(rng.getrandbits(8) for _ in range(size // 2)) * 2
+            zipf.writestr("assets/oraxen/textures/item/texture_%d.png" % i, data)
+    return buf.getvalue()
+
+
+def digest_tree(folder):
+    sha1 = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(folder)):
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            sha1.update(os.path.relpath(path, folder).encode("utf-8"))
+            with open(path, "rb") as f:
+                sha1.update(f.read())
+    return sha1.hexdigest()
+
+
+def bench(pack, threads):
+    with tempfile.TemporaryDirectory() as folder:
+        start = time.perf_counter()
+        dmgzipext.extract_damaged_zip_buf(pack, folder, threads)
+        elapsed = time.perf_counter() - start
+        return elapsed, digest_tree(folder)
+
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    pack = synthetic_pack(entries)
+    print("pack: %d entries, %.1f MB" % (entries, len(pack) / 1e6))
+
+    serial, serial_digest = bench(pack, 1)
+    parallel, parallel_digest = bench(pack, threads)
+    print("serial:            %.3fs" % serial)
+    print("parallel (%2d thr): %.3fs (x%.2f)" % (threads, parallel, serial / parallel))
+    print("identical output: %s" % (serial_digest == parallel_digest))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+from polymath import workers
+from polymath.config import TomlConfig
+from polymath.packs import PacksManager
+
+REPORT_FIELDS = ("file", "status", "sha1", "input_size", "output_size", "deduplicated", "wall", "cpu", "stages", "error")
+
+
+def file_digest(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+async def convert_one(packs_manager, path, spigot_id, output):
+    """
+    Registers one pack like an upload would.
+
+    Args:
+        packs_manager (PacksManager): Where the pack is converted and registered
+        path (str): The zip of the pack
+        spigot_id (str): Id the pack is registered with
+        output (str): Folder a copy of the converted pack is written to, or None
+
+    Returns:
+        dict: The line of the report about this pack, with the wall and CPU
+        time of the conversion itself, not of its wait for a worker, empty
+        when the pack was already converted
+    """
+    loop = asyncio.get_running_loop()
+    result = dict.fromkeys(REPORT_FIELDS, "")
+    result["file"] = path
+    # any error is reported on the line of the pack, the other packs go on
+    try:
+        result["input_size"] = os.path.getsize(path)
+        digest = await loop.run_in_executor(None, file_digest, path)
+        id_hash, stats = await packs_manager.register_async(path, spigot_id, "127.0.0.1", digest)
+        pack_file = packs_manager.pack_path(id_hash)
+        result["sha1"] = id_hash
+        result["output_size"] = os.path.getsize(pack_file)
+        result["deduplicated"] = packs_manager.registry[id_hash]["deduplicated"]
+        if stats is not None:
+            result["wall"] = round(stats.wall(), 3)
+            result["cpu"] = round(stats.cpu(), 3)
+            result["stages"] = " ".join("%s=%.3f" % (stage.name, stage.wall) for stage in stats.stages)
+        if output is not None:
+            name = os.path.splitext(os.path.basename(path))[0]
+            shutil.copyfile(pack_file, os.path.join(output, name + ".zip"))
+        result["status"] = "ok"
+    except asyncio.TimeoutError:
+        result["status"] = "timeout"
+    except workers.WorkerError as e:
+        result["status"] = "failed"
+        # the last line of the traceback is the error itself
+        result["error"] = str(e).strip().splitlines()[-1] if str(e).strip() else ""
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = repr(e)
+    if result["wall"] == "":
+        logging.info("%s: %s", path, result["status"])
+    else:
+        logging.info("%s: %s in %.3fs", path, result["status"], result["wall"])
+    return result
+
+
+def write_report(results, report):
+    """Writes the results as CSV if the report file ends with .csv, as JSON otherwise."""
+    with open(report, "w", newline="") as f:
+        if report.lower().endswith(".csv"):
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(results)
+        else:
+            json.dump(results, f, indent=4)
+
+
+async def convert_all(config, paths, args):
+    packs_manager = PacksManager(config)
+    # every pack is queued at once, the pool runs as many as it has processes
+    config["workers"]["queue_size"] = len(paths)
+    if args.processes:
+        config["workers"]["processes"] = args.processes
+    packs_manager.start_workers()
+    try:
+        return await asyncio.gather(
+            *(convert_one(packs_manager, path, args.id, args.output) for path in paths)
+        )
+    finally:
+        packs_manager.workers.shutdown()
+
+
+def main(argv=None):
+    """
+    Converts every zip of a folder with the same pipeline as uploads, the
+    converted packs are registered in the storage of the server. Run it while
+    the server is stopped, both would write the registry.
+
+        python bulk <folder> [--report report.csv] [--output converted/] [--processes 4]
+    """
+    parser = argparse.ArgumentParser(prog="bulk", description="Converts a folder of resource packs like uploads.")
+    parser.add_argument("folder", help="folder of the zips to convert")
+    parser.add_argument("--report", default="report.json", help="report file, CSV if it ends with .csv, JSON otherwise")
+    parser.add_argument("--output", help="folder where a copy of each converted pack is written")
+    parser.add_argument("--processes", type=int, default=0, help="worker processes, [workers] processes by default")
+    parser.add_argument("--id", default="bulk", help="id the packs are registered with")
+    args = parser.parse_args(argv)
+
+    config = TomlConfig("config/settings.toml", "config/settings.template.toml")
+    if not config.configured:
+        return 1
+    logging.basicConfig(level=config["extra"]["debug_level"], format="[%(asctime)s] [%(levelname)s] %(message)s")
+
+    paths = sorted(
+        os.path.join(args.folder, name) for name in os.listdir(args.folder) if name.lower().endswith(".zip")
+    )
+    if args.output is not None:
+        os.makedirs(args.output, exist_ok=True)
+
+    start = time.perf_counter()
+    results = asyncio.run(convert_all(config, paths, args))
+    write_report(results, args.report)
+
+    failed = sum(1 for result in results if result["status"] != "ok")
+    print("Converted %d packs in %.1fs, %d failed, report written to %s" % (
+        len(results) - failed, time.perf_counter() - start, failed, args.report
+    ))
+    return 1 if failed else 0
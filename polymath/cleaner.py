@@ -1,31 +1,205 @@
 import asyncio
+import logging
 import time
 import os
 
+# Files of the packs folder younger than that may belong to a conversion not registered yet
+ORPHAN_GRACE = 3600
+
 
 async def start(packs_manager, config):
+    """
+    Removes the expired packs, and the least recently downloaded ones past
+    max_storage, every [cleaner] delay seconds. Reconciles the registry with
+    the packs folder every orphans_delay seconds.
+    """
+    reconciler = asyncio.get_running_loop().create_task(start_reconciler(packs_manager, config))
+    try:
+        while True:
+            await expire(packs_manager, config)
+            await evict(packs_manager, config)
+            await asyncio.sleep(config["cleaner"]["delay"])
+    finally:
+        reconciler.cancel()
+
+
+async def start_reconciler(packs_manager, config):
+    while True:
+        await reconcile(packs_manager, config)
+        await asyncio.sleep(config["cleaner"]["orphans_delay"])
+
+
+def remove_packs(packs_manager, ids):
+    for id_hash in ids:
+        packs_manager.registry.pop(id_hash, None)
+        try:
+            os.remove(packs_manager.pack_path(id_hash))
+        except FileNotFoundError:
+            pass
+
+
+def expire_batch(packs_manager, before, batch_size):
+    """
+    Removes the packs last downloaded before a time, found with the index of
+    the registry on last_download, the oldest first.
+
+    Returns:
+        list: Ids of the removed packs, batch_size of them at most
+    """
+    ids = packs_manager.registry.expired(before, batch_size)
+    remove_packs(packs_manager, ids)
+    return ids
+
+
+async def expire(packs_manager, config):
+    """
+    Removes the packs not downloaded for pack_lifespan seconds, in batches
+    run on the executor so downloads are served in between.
+
+    Returns:
+        int: Packs removed
+    """
+    loop = asyncio.get_running_loop()
+    batch_size = config["cleaner"]["batch_size"]
+    before = time.time() - config["cleaner"]["pack_lifespan"]
+    removed = 0
+    while True:
+        # the last downloads have to be in the registry to be taken into account
+        packs_manager.downloads.flush()
+        ids = await loop.run_in_executor(None, expire_batch, packs_manager, before, batch_size)
+        for id_hash in ids:
+            packs_manager.hot_packs.discard(id_hash)
+        removed += len(ids)
+        if len(ids) < batch_size:
+            break
+    if removed:
+        logging.info("Removed " + str(removed) + " expired packs")
+    return removed
+
+
+def evict_batch(packs_manager, excess, batch_size):
+    """
+    Removes the least recently downloaded packs until excess bytes are freed.
+
+    Returns:
+        list: Ids of the removed packs, batch_size of them at most
+    """
+    ids = []
+    for id_hash, size in packs_manager.registry.oldest(batch_size):
+        if excess <= 0:
+            break
+        ids.append(id_hash)
+        excess -= size
+    remove_packs(packs_manager, ids)
+    return ids
+
+
+async def evict(packs_manager, config):
+    """
+    Removes the least recently downloaded packs while the packs take more
+    than max_storage bytes, in batches like expire.
+
+    Returns:
+        int: Packs removed
+    """
+    max_storage = config["cleaner"]["max_storage"]
+    if not max_storage:
+        return 0
+    loop = asyncio.get_running_loop()
+    removed = 0
     while True:
-        clean(packs_manager, config)
-        await asyncio.sleep(config["cleaner"]["delay"])
-
-
-def clean(packs_manager, config):
-    for id_hash in list(packs_manager.registry.keys()):  # workaround to "copy" the keys
-        pack = packs_manager.registry[id_hash]
-        pack_file = packs_manager.packs_folder + id_hash
-
-        if not os.path.exists(pack_file):
-            packs_manager.registry.pop(id_hash)
-        elif (
-            time.time() - packs_manager.registry[id_hash]["last_download"]
-            > config["cleaner"]["pack_lifespan"]
-        ):
-            packs_manager.registry.pop(id_hash)
-            os.remove(pack_file)
-
-    for id_hash in os.listdir(packs_manager.packs_folder):
-        if (
-            os.path.isfile(os.path.join(packs_manager.packs_folder, id_hash))
-            and id_hash not in packs_manager.registry
-        ):
-            os.remove(os.path.join(packs_manager.packs_folder, id_hash))
+        packs_manager.downloads.flush()
+        excess = packs_manager.registry.total_size() - max_storage
+        if excess <= 0:
+            break
+        ids = await loop.run_in_executor(None, evict_batch, packs_manager, excess, config["cleaner"]["batch_size"])
+        for id_hash in ids:
+            packs_manager.hot_packs.discard(id_hash)
+        removed += len(ids)
+        if not ids:
+            break
+    if removed:
+        logging.info("Removed " + str(removed) + " packs over the storage budget")
+    return removed
+
+
+def find_orphans(packs_manager):
+    """
+    Returns:
+        tuple: (paths of the files that aren't registered packs, registered packs without a file,
+                registered packs whose size isn't the one of their file)
+    """
+    files = {}
+    orphan_files = []
+    recent = time.time() - ORPHAN_GRACE
+    # listed before the registry is read, so a pack registered in between isn't an orphan
+    with os.scandir(packs_manager.packs_folder) as shards:
+        for shard in shards:
+            if not shard.is_dir():
+                continue
+            with os.scandir(shard.path) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files[entry.name] = stat.st_size
+                        if stat.st_mtime < recent:
+                            orphan_files.append(entry.path)
+    registered = packs_manager.registry.sizes()
+    orphan_files = [path for path in orphan_files if os.path.basename(path) not in registered]
+    missing = [
+        id_hash for id_hash in registered if id_hash not in files and not os.path.exists(packs_manager.pack_path(id_hash))
+    ]
+    wrong_sizes = {
+        id_hash: files[id_hash] for id_hash, size in registered.items() if id_hash in files and files[id_hash] != size
+    }
+    return orphan_files, missing, wrong_sizes
+
+
+def unregistered(packs_manager, ids):
+    return [id_hash for id_hash in ids if id_hash not in packs_manager.registry]
+
+
+def remove_orphans(packs_manager, orphan_files, missing, wrong_sizes):
+    # checked again, the same pack may have been uploaded since they were found
+    for path in orphan_files:
+        if os.path.basename(path) in packs_manager.registry:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    for id_hash in missing:
+        if not os.path.exists(packs_manager.pack_path(id_hash)):
+            packs_manager.registry.pop(id_hash, None)
+    # registered before sizes were recorded, max_storage needs them
+    updates = {}
+    for id_hash, size in wrong_sizes.items():
+        entry = packs_manager.registry.get(id_hash)
+        if entry is not None:
+            entry["size"] = size
+            updates[id_hash] = entry
+    if updates:
+        packs_manager.registry.update_existing(updates)
+
+
+async def reconcile(packs_manager, config):
+    """
+    Removes the files of the packs folder that aren't registered and the
+    registered packs whose file is gone, then trims the caches. It goes
+    through every pack, so it runs much less often than expire.
+    """
+    loop = asyncio.get_running_loop()
+    orphan_files, missing, wrong_sizes = await loop.run_in_executor(None, find_orphans, packs_manager)
+    await loop.run_in_executor(None, remove_orphans, packs_manager, orphan_files, missing, wrong_sizes)
+    if orphan_files or missing:
+        logging.info(
+            "Removed " + str(len(orphan_files)) + " unregistered pack files and "
+            + str(len(missing)) + " registered packs without a file"
+        )
+
+    await loop.run_in_executor(None, packs_manager.conversions.prune)
+    # the hot cache is only changed on the loop, the registry is read on the executor
+    hot_ids = list(packs_manager.hot_packs.packs)
+    for id_hash in await loop.run_in_executor(None, unregistered, packs_manager, hot_ids):
+        packs_manager.hot_packs.discard(id_hash)
+    await loop.run_in_executor(None, packs_manager.png_cache.trim, config["cache"]["png"])
@@ -19,10 +19,13 @@ class TomlConfig(Config):
     def __init__(self, file_name, template_name):
         self.configured = True
         config_file = self.extract(file_name, template_name)
-        self.load(config_file)
+        self.load(config_file, utils.get_path(template_name))
 
-    def load(self, config_file):
-        self._config = toml.load(config_file)
+    def load(self, config_file, template_file):
+        # settings added since the config file was copied keep their template value
+        self._config = utils.merge(
+            utils.to_plain(toml.load(template_file)), utils.to_plain(toml.load(config_file))
+        )
 
     def __getitem__(self, key):
         return self._config[key]
\ No newline at end of file
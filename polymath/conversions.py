@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import time
+
+# Bump this when a change to the pipeline changes the packs it produces
+PIPELINE_VERSION = 1
+
+
+def pipeline_fingerprint(settings):
+    """
+    Identifies the pipeline a pack went through.
+
+    Args:
+        settings (dict): The [pipeline] section of the settings
+
+    Returns:
+        str: A short hash of the pipeline version and its settings
+    """
+    dump = json.dumps([PIPELINE_VERSION, settings], sort_keys=True)
+    return hashlib.sha1(dump.encode("utf-8")).hexdigest()[:12]
+
+
+class ConversionCache:
+    """
+    Remembers which pack was produced from an upload, so the same upload
+    doesn't have to be converted again.
+
+    Stored in a table of the registry database: a lookup or an eviction
+    changes a few rows instead of rewriting the cache, and the entries of
+    packs that are gone are removed with one query. A conversions.json left
+    by a previous version is imported on first start.
+
+    Args:
+        registry (Registry): The registry of the packs, its database holds the cache
+        max_entries (int): Least recently used entries above that are evicted, 0 disables the cache
+        settings (dict): The [pipeline] section of the settings
+    """
+
+    def __init__(self, registry, max_entries, settings):
+        self.connection = registry.connection
+        self.lock = registry.lock
+        self.max_entries = max_entries
+        self.fingerprint = pipeline_fingerprint(settings)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS conversions (key TEXT PRIMARY KEY, id TEXT NOT NULL, last_used REAL NOT NULL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS conversions_last_used ON conversions (last_used)")
+        self.migrate(os.path.join(os.path.dirname(registry.file), "conversions.json"))
+
+    def migrate(self, json_file):
+        """Imports the entries of the JSON cache and renames it so it isn't imported again."""
+        if not os.path.isfile(json_file):
+            return
+        with open(json_file, "r") as f:
+            entries = json.load(f)
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO conversions VALUES (?, ?, ?)",
+                [(key, entry["id"], entry["last_used"]) for key, entry in entries.items()],
+            )
+        os.replace(json_file, json_file + ".migrated")
+
+    def key(self, digest):
+        return digest + "-" + self.fingerprint
+
+    def get(self, digest):
+        """
+        Args:
+            digest (str): SHA256 of the uploaded pack
+
+        Returns:
+            str: Id of the pack converted from that upload, None if unknown
+        """
+        if not self.max_entries:
+            return None
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT id FROM conversions WHERE key = ?", (self.key(digest),)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                "UPDATE conversions SET last_used = ? WHERE key = ?", (time.time(), self.key(digest))
+            )
+        return row[0]
+
+    def put(self, digest, id_hash):
+        if not self.max_entries:
+            return
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO conversions VALUES (?, ?, ?)", (self.key(digest), id_hash, time.time())
+            )
+            # walks the index on last_used, the entries past max_entries are the least recently used
+            self.connection.execute(
+                "DELETE FROM conversions WHERE key IN "
+                "(SELECT key FROM conversions ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def discard(self, digest):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM conversions WHERE key = ?", (self.key(digest),))
+
+    def prune(self):
+        """Removes the entries of packs that aren't in the registry anymore."""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM conversions WHERE id NOT IN (SELECT id FROM packs)")
@@ -1,9 +1,25 @@
 import json
+import logging
 import os
 import shutil
-from polymath import utils
+import multiprocessing
+
+# Vanilla item models with a dedicated structure, by lowercased file name
+HEAD_MODELS = {
+	"player_head.json": ("player", "minecraft:item/template_skull"),
+	"piglin_head.json": ("piglin", "minecraft:item/template_skull"),
+	"zombie_head.json": ("zombie", "minecraft:item/template_skull"),
+	"creeper_head.json": ("creeper", "minecraft:item/template_skull"),
+	"dragon_head.json": ("dragon", "minecraft:item/dragon_head"),
+	"wither_skeleton_skull.json": ("wither_skeleton", "minecraft:item/template_skull"),
+	"skeleton_skull.json": ("skeleton", "minecraft:item/template_skull")
+}
+POTION_MODELS = frozenset(("potion.json", "splash_potion.json", "lingering_potion.json"))
+CHEST_MODELS = {"chest.json": "chest", "trapped_chest.json": "trapped_chest"}
 
 # Helper functions to check model types (Simplified and using English strings)
+# convert_json_format uses ModelKind, the helpers it doesn't call anymore are
+# kept as the reference tests/test_model_kind.py checks ModelKind against
 
 def is_fishing_rod_model(json_data, file_path=""):
 	"""Check if the JSON data represents a fishing rod model."""
@@ -70,17 +86,8 @@ def get_shield_model(cmd_value, base_model, blocking_model, json_data):
 def is_head_model(json_data, file_path=""):
 	"""Check if the JSON data represents a head/skull model."""
 	normalized_path = os.path.basename(file_path).lower()
-	head_mappings = {
-		"player_head.json": ("player", "minecraft:item/template_skull"),
-		"piglin_head.json": ("piglin", "minecraft:item/template_skull"),
-		"zombie_head.json": ("zombie", "minecraft:item/template_skull"),
-		"creeper_head.json": ("creeper", "minecraft:item/template_skull"),
-		"dragon_head.json": ("dragon", "minecraft:item/dragon_head"),
-		"wither_skeleton_skull.json": ("wither_skeleton", "minecraft:item/template_skull"),
-		"skeleton_skull.json": ("skeleton", "minecraft:item/template_skull")
-	}
-	if normalized_path in head_mappings:
-		return True, head_mappings[normalized_path][0], head_mappings[normalized_path][1]
+	if normalized_path in HEAD_MODELS:
+		return (True,) + HEAD_MODELS[normalized_path]
 	return False, None, None
 
 def is_damage_model(json_data):
@@ -96,18 +103,12 @@ def is_damage_model(json_data):
 
 def is_potion_model(json_data, file_path=""):
 	"""Check if the JSON data represents a potion model."""
-	normalized_path = os.path.basename(file_path).lower()
-	potion_files = ["potion.json", "splash_potion.json", "lingering_potion.json"]
-	return normalized_path in potion_files
+	return os.path.basename(file_path).lower() in POTION_MODELS
 
 def is_chest_model(json_data, file_path=""):
 	"""Check if the JSON data represents a chest or trapped chest model."""
-	normalized_path = os.path.basename(file_path).lower()
-	if normalized_path == "chest.json":
-		return True, "chest"
-	elif normalized_path == "trapped_chest.json":
-		return True, "trapped_chest"
-	return False, None
+	chest_type = CHEST_MODELS.get(os.path.basename(file_path).lower())
+	return chest_type is not None, chest_type
 
 def has_mixed_custom_damage(json_data):
 	"""Check if JSON data contains both custom_model_data and damage predicates."""
@@ -123,6 +124,45 @@ def has_mixed_custom_damage(json_data):
 			break
 	return cmd_with_damage
 
+class ModelKind:
+	"""
+	Everything convert_json_format checks about a model, worked out with one
+	look at its file name and one pass over its overrides. Gives the same
+	answers as the is_*_model helpers above, which a model can match several
+	of, tests/test_model_kind.py checks it on a corpus of models.
+	"""
+
+	__slots__ = ("head", "chest", "potion", "shield", "fishing_rod", "bow", "crossbow", "mixed_damage", "damage")
+
+	def __init__(self, json_data, file_path=""):
+		normalized_filename = os.path.basename(file_path).lower()
+		filename_without_ext = os.path.splitext(normalized_filename)[0]
+		self.head = HEAD_MODELS.get(normalized_filename) # (kind, base model) of heads
+		self.chest = CHEST_MODELS.get(normalized_filename) # chest type of chests
+		self.potion = normalized_filename in POTION_MODELS
+		self.bow = filename_without_ext == "bow"
+		self.crossbow = filename_without_ext == "crossbow"
+
+		blocking = cast = mixed_damage = damage = False
+		if "overrides" in json_data:
+			for override in json_data["overrides"]:
+				predicate = override.get("predicate", {})
+				if "damaged" in predicate and "damage" in predicate:
+					if "custom_model_data" in predicate:
+						mixed_damage = True
+					else:
+						damage = True
+				if "blocking" in predicate:
+					blocking = True
+				if "cast" in predicate:
+					cast = True
+
+		parent = json_data.get("parent")
+		self.shield = normalized_filename == "shield.json" or (parent == "builtin/entity" and blocking)
+		self.fishing_rod = normalized_filename == "fishing_rod.json" or (parent == "item/handheld_rod" and cast)
+		self.mixed_damage = mixed_damage
+		self.damage = damage
+
 # Conversion functions (Simplified and using English strings)
 
 def convert_damage_model(json_data, base_texture=""):
@@ -227,28 +267,27 @@ def convert_json_format(json_data, is_item_model=False, file_path=""):
 	parent_path = json_data.get("parent", "")
 	base_path = base_texture or parent_path
 
-	is_potion = is_potion_model(json_data, file_path)
+	kind = ModelKind(json_data, file_path)
+	is_potion = kind.potion
 	if is_potion:
 		textures = json_data.get("textures", {})
 		if textures.get("layer0") == "item/splash_potion_overlay": base_path = "minecraft:item/splash_potion"
 		elif textures.get("layer0") == "item/lingering_potion_overlay": base_path = "minecraft:item/lingering_potion"
 		else: base_path = "minecraft:item/potion"
 
-	is_chest, chest_type = is_chest_model(json_data, file_path)
-	is_head, head_kind, head_base = is_head_model(json_data, file_path)
-	is_shield = is_shield_model(json_data, file_path)
-	is_fishing_rod = is_fishing_rod_model(json_data, file_path)
-	normalized_filename = os.path.basename(file_path).lower()
-	filename_without_ext = os.path.splitext(normalized_filename)[0]
-	is_bow = (normalized_filename == "bow.json") or (not is_chest and filename_without_ext == "bow")
-	is_crossbow = (normalized_filename == "crossbow.json") or (not is_chest and filename_without_ext == "crossbow")
+	is_chest, chest_type = kind.chest is not None, kind.chest
+	is_shield = kind.shield
+	is_fishing_rod = kind.fishing_rod
+	is_bow = kind.bow
+	is_crossbow = kind.crossbow
 
-	if has_mixed_custom_damage(json_data):
+	if kind.mixed_damage:
 		return convert_mixed_custom_damage_model(json_data)
-	if is_damage_model(json_data):
+	if kind.damage:
 		return convert_damage_model(json_data, base_path)
 
-	if is_head:
+	if kind.head is not None:
+		head_kind, head_base = kind.head
 		if not head_base.startswith("minecraft:"): head_base = f"minecraft:{head_base}"
 		new_format = {
 			"model": {
@@ -650,101 +689,239 @@ def adjust_folder_structure(base_dir):
 			if os.path.exists(models_item_path) and not os.listdir(models_item_path):
 				shutil.rmtree(models_item_path)
 
+def adjust_tree_structure(tree):
+	"""
+	Same as adjust_folder_structure, for a PackTree
+
+	Args:
+		tree (PackTree): Tree to adjust structure in
+	"""
+	models_item_path = "assets/minecraft/models/item/"
+	items_path = "assets/minecraft/items/"
+
+	# Only process files directly in models/item
+	for name in [n for n in tree if n.startswith(models_item_path) and "/" not in n[len(models_item_path):]]:
+		dst_name = items_path + name[len(models_item_path):]
+
+		# Handle existing file
+		if dst_name in tree:
+			tree.move(dst_name, f"{dst_name}.bak")
+
+		tree.move(name, dst_name)
+
+# --- Pre-scan ---
+
+def may_need_conversion(data):
+	"""
+	Byte-level check run before parsing a JSON file. Only models overriding
+	custom_model_data are converted, anything without both keys in its raw
+	bytes can be skipped without being parsed.
+
+	Args:
+		data: Raw content of the file.
+
+	Returns:
+		bool: False when the file certainly doesn't need converting.
+	"""
+	return b'custom_model_data' in data and b'overrides' in data
+
+def scan_pack_directory(source_pack_path):
+	"""
+	Indexes the JSON files of an extracted pack that may need converting.
+
+	Args:
+		source_pack_path: Path to the extracted source resource pack directory.
+
+	Returns:
+		tuple: (number of files in the pack, list of (relative_path, context_path, data))
+	"""
+	files_count = 0
+	items = []
+	for root, dirs, files in os.walk(source_pack_path):
+		files_count += len(files)
+		for file in files:
+			if not file.lower().endswith('.json'):
+				continue
+			source_file = os.path.join(root, file)
+			try:
+				with open(source_file, 'rb') as f:
+					data = f.read()
+			except Exception as e:
+				logging.warning(f"Error reading file {source_file}: {e}")
+				continue
+			if may_need_conversion(data):
+				items.append((os.path.relpath(source_file, source_pack_path), source_file, data))
+	return files_count, items
+
+def scan_pack_tree(source_tree):
+	"""
+	Same as scan_pack_directory, for a PackTree.
+
+	Args:
+		source_tree: PackTree of the source resource pack.
+
+	Returns:
+		tuple: (number of files in the pack, list of (name, name, data))
+	"""
+	items = []
+	for name in list(source_tree):
+		if name.lower().endswith('.json'):
+			data = source_tree[name]
+			if may_need_conversion(data):
+				items.append((name, name, data))
+	return len(source_tree), items
+
+# --- Parallel Conversion ---
+
+_pool = None
+_pool_processes = 0
+
+def convert_json_file(relative_path, context_path, data):
+	"""
+	Converts a single JSON file of a pack.
+
+	Args:
+		relative_path: Path of the file in the pack, used in messages.
+		context_path: Path given to convert_json_format to recognize the model.
+		data: Raw content of the file.
+
+	Returns:
+		tuple: (converted file as bytes or None if it isn't kept, error message or None)
+	"""
+	try:
+		try:
+			json_data = json.loads(data.decode('utf-8'))
+		except json.JSONDecodeError as jde:
+			return None, f"Error decoding JSON in {relative_path}: {jde}. Skipping."
+
+		# CMD mode conversion logic
+		should_convert = (
+			"overrides" in json_data and
+			any("custom_model_data" in o.get("predicate", {}) for o in json_data.get("overrides", []))
+		)
+		if not should_convert:
+			return None, None
+
+		converted_data = convert_json_format(json_data, is_item_model=False, file_path=context_path)
+		return json.dumps(converted_data, indent=4).encode('utf-8'), None
+	except Exception as e:
+		return None, f"Error processing file {relative_path}: {e}"
+
+def convert_json_chunk(chunk):
+	"""convert_json_file over a list of (relative_path, context_path, data), run in the pool."""
+	return [(item[0],) + convert_json_file(*item) for item in chunk]
+
+def convert_json_files(items, processes=1, chunk_size=64):
+	"""
+	Converts JSON files, fanned out in chunks over a process pool when there
+	are enough of them. Results come back in the order of items.
+
+	Args:
+		items: List of (relative_path, context_path, data).
+		processes: Size of the process pool, 1 converts in this process.
+		chunk_size: Files sent to a pool process at once.
+
+	Returns:
+		list: (relative_path, converted bytes or None, message or None) per item.
+	"""
+	global _pool, _pool_processes
+	if processes <= 1 or len(items) <= chunk_size:
+		return convert_json_chunk(items)
+
+	if _pool is None or _pool_processes != processes:
+		shutdown_pool()
+		# kept for the next packs, starting processes costs more than converting most packs
+		_pool = multiprocessing.Pool(processes)
+		_pool_processes = processes
+
+	chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+	results = []
+	for chunk_results in _pool.imap(convert_json_chunk, chunks):
+		results.extend(chunk_results)
+	return results
+
+def shutdown_pool():
+	"""Stops the processes of convert_json_files."""
+	global _pool
+	if _pool is not None:
+		_pool.terminate()
+		_pool = None
+
 # --- Core Conversion Function ---
 
-def convert_resource_pack(source_pack_path: str, output_path: str):
+def convert_resource_pack(source_pack_path: str, output_path: str, processes: int = 1, chunk_size: int = 64):
 	"""
 	Converts an extracted Minecraft resource pack directory.
 
 	Args:
 		source_pack_path: Path to the extracted source resource pack directory.
 		output_path: Path where the converted pack directory will be saved.
-	"""
-	print(f"Starting resource pack conversion...")
-	print(f"Source: {source_pack_path}")
-	print(f"Output: {output_path}")
+		processes: See convert_json_files.
+		chunk_size: See convert_json_files.
 
+	Returns:
+		int: Number of converted files.
+	"""
 	if not os.path.isdir(source_pack_path):
-		print(f"Error: Source directory '{source_pack_path}' not found or is not a directory.")
-		return
+		logging.error(f"Source directory '{source_pack_path}' not found or is not a directory.")
+		return 0
 
-	processed_files_count = 0
 	converted_files_count = 0
-	copied_files_count = 0
 
 	# Create output directory structure
 	os.makedirs(output_path, exist_ok=True)
 
-	# --- Step 1: Copy all files initially ---
-	print("\nStep 1: Copying all files...")
-	files_to_process = []
-	for root, dirs, files in os.walk(source_pack_path):
-		relative_path = os.path.relpath(root, source_pack_path)
-		output_root = os.path.join(output_path, relative_path)
-		os.makedirs(output_root, exist_ok=True)
+	# --- Step 1: Index the JSON files that may need converting ---
+	processed_files_count, items = scan_pack_directory(source_pack_path)
 
-		for file in files:
-			processed_files_count += 1
-			source_file = os.path.join(root, file)
-			dest_file = os.path.join(output_root, file)
-			try:
-				if file.lower().endswith('.json'):
-					shutil.copy2(source_file, dest_file)
-					files_to_process.append((dest_file, source_file)) # Store (output_path, original_input_path)
-			except Exception as e:
-				print(f"Error copying file {source_file} to {dest_file}: {e}")
+	# --- Step 2: Convert them, only the converted files are written ---
+	for relative_path, converted, message in convert_json_files(items, processes, chunk_size):
+		if message:
+			logging.warning(message)
+		if converted is None:
+			continue # Don't copy since we're doing overlays
+		output_file = os.path.join(output_path, relative_path)
+		try:
+			os.makedirs(os.path.dirname(output_file), exist_ok=True)
+			with open(output_file, 'wb') as f:
+				f.write(converted)
+			converted_files_count += 1
+		except Exception as e:
+			logging.warning(f"Error writing file {output_file}: {e}")
 
-	# --- Step 2: Process JSON files based on mode ---
-	print(f"\nStep 2: Processing {len(files_to_process)} JSON files...")
+	# --- Step 3: Correct the folder structure ---
+	adjust_folder_structure(output_path)
 
-	for output_file, source_file_path_for_context in files_to_process:
-		relative_path = os.path.relpath(output_file, output_path)
-		try:
-			with open(output_file, 'r+', encoding='utf-8') as f:
-				try:
-					json_data = json.load(f)
-				except json.JSONDecodeError as jde:
-					print(f"Error decoding JSON in {relative_path}: {jde}. Skipping.")
-					f.close()
-					os.remove(output_file) # Don't copy since we're doing overlays
-					continue # Skip this file
-
-				# CMD mode conversion logic
-				should_convert = (
-					"overrides" in json_data and
-					any("custom_model_data" in o.get("predicate", {}) for o in json_data.get("overrides", []))
-				)
-
-				if should_convert:
-					print(f"  Converting: {relative_path}")
-					converted_data = convert_json_format(json_data, is_item_model=False, file_path=source_file_path_for_context)
-					f.seek(0)
-					json.dump(converted_data, f, indent=4)
-					f.truncate()
-					converted_files_count += 1
-				else:
-					# print(f"  Skipping conversion (no CMD): {relative_path}")
-					f.close()
-					os.remove(output_file) # Don't copy since we're doing overlays
+	logging.debug(f"Converted {converted_files_count} of {processed_files_count} files of {source_pack_path}")
+	return converted_files_count
 
-		except Exception as e:
-			print(f"Error processing file {output_file}: {e}")
-			os.remove(output_file) # Don't copy since we're doing overlays
+def convert_resource_tree(source_tree, output_tree, processes=1, chunk_size=64):
+	"""
+	Converts a resource pack held in a PackTree, same as convert_resource_pack.
 
-	print(f"\nStep 3: Removing empty directories...")
-	utils.remove_empty_dirs(output_path)
+	Args:
+		source_tree: PackTree of the source resource pack.
+		output_tree: PackTree where the converted files will be written.
+		processes: See convert_json_files.
+		chunk_size: See convert_json_files.
 
-	print(f"\nStep 4: Correcting folder structure...")
-	adjust_folder_structure(output_path)
+	Returns:
+		int: Number of converted files.
+	"""
+	converted_files_count = 0
+	processed_files_count, items = scan_pack_tree(source_tree)
+
+	for name, converted, message in convert_json_files(items, processes, chunk_size):
+		if message:
+			logging.warning(message)
+		if converted is not None:
+			output_tree[name] = converted
+			converted_files_count += 1
+
+	adjust_tree_structure(output_tree)
 
-	print("\n--------------------")
-	print("Conversion Summary:")
-	print(f"- Total Files Processed: {processed_files_count}")
-	print(f"- Files Converted/Generated: {converted_files_count}")
-	print(f"- Files Copied (Unchanged): {copied_files_count}")
-	print(f"- Output Location: {output_path}")
-	print("--------------------")
-	print("Processing complete!")
+	logging.debug(f"Converted {converted_files_count} of {processed_files_count} files")
+	return converted_files_count
 
 # Example Usage (Optional - Can be removed or commented out)
 # if __name__ == "__main__":
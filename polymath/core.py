@@ -27,6 +27,8 @@ async def main():
         format="[%(asctime)s] "+Fore.YELLOW+"[%(levelname)s] "+Fore.RESET+"%(message)s",
         filename= str(config['extra']['log2file']) if str(config['extra']['log2file']) != "-1" else None
     )
+    # after logging is set up, so the workers log the same way
+    packs_manager.start_workers()
 
     server.setup(app, config, packs_manager) # setup the routes and server.
 
@@ -45,7 +47,13 @@ async def main():
     
     await runner.setup()
     await web.TCPSite(runner,host=host_ip ,port=config["server"]["port"]).start()
-    await cleaner.start(packs_manager, config)
-    await asyncio.Event().wait()
-    
-asyncio.run(main())
\ No newline at end of file
+    packs_manager.downloads.start(config["cleaner"]["downloads_delay"])
+    try:
+        await cleaner.start(packs_manager, config)
+        await asyncio.Event().wait()
+    finally:
+        await packs_manager.downloads.stop()
+
+
+def start():
+    asyncio.run(main())
\ No newline at end of file
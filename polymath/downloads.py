@@ -0,0 +1,72 @@
+import asyncio
+import logging
+import time
+
+
+class DownloadTracker:
+    """
+    Counts the downloads of packs in memory and writes them to the registry
+    in batches, a download costs a dict update instead of a registry write.
+    Each flush sets last_download and adds to the downloads count of the
+    packs downloaded since the last one.
+
+    Args:
+        registry (Registry): The registry of the packs
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        # id of the pack: (time of the last download, downloads)
+        self.pending = {}
+        self.task = None
+
+    def hit(self, id_hash):
+        _, count = self.pending.get(id_hash, (0, 0))
+        self.pending[id_hash] = (int(time.time()), count + 1)
+
+    def flush(self):
+        """
+        Writes the pending downloads to the registry at once.
+
+        Returns:
+            int: Packs updated
+        """
+        pending, self.pending = self.pending, {}
+        updates = {}
+        for id_hash, (last_download, count) in pending.items():
+            entry = self.registry.get(id_hash)
+            if entry is None:
+                # removed by the cleaner in between
+                continue
+            entry = dict(entry)
+            entry["last_download"] = last_download
+            entry["downloads"] = entry.get("downloads", 0) + count
+            updates[id_hash] = entry
+        if not updates:
+            return 0
+        # the cleaner may remove some of them from its executor meanwhile
+        return self.registry.update_existing(updates)
+
+    def start(self, delay):
+        """Flushes every delay seconds on the running loop, until stop."""
+        self.task = asyncio.get_running_loop().create_task(self.run(delay))
+
+    async def stop(self):
+        """Stops the flushes once the pending downloads are written."""
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def run(self, delay):
+        """Flushes every delay seconds, and a last time when cancelled."""
+        try:
+            while True:
+                await asyncio.sleep(delay)
+                logging.debug("Recorded the downloads of " + str(self.flush()) + " packs")
+        finally:
+            self.flush()
@@ -0,0 +1,84 @@
+import asyncio
+import collections
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class HotPackCache:
+    """
+    Keeps the bytes of the most downloaded packs in memory, least recently
+    used packs are evicted once max_size is reached. Packs are stored under
+    their id, which is the hash of their content, so an entry never goes
+    stale: it only has to be dropped when its pack is removed.
+
+    Args:
+        max_size (int): Total bytes of the packs kept in memory, 0 disables the cache
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.packs = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # reads in progress, so a burst of downloads of the same pack reads it once
+        self.loading = {}
+
+    def get(self, id_hash):
+        data = self.packs.get(id_hash)
+        if data is not None:
+            self.packs.move_to_end(id_hash)
+        return data
+
+    def put(self, id_hash, data):
+        if len(data) > self.max_size or id_hash in self.packs:
+            return
+        self.packs[id_hash] = data
+        self.size += len(data)
+        while self.size > self.max_size:
+            _, evicted = self.packs.popitem(last=False)
+            self.size -= len(evicted)
+
+    def discard(self, id_hash):
+        data = self.packs.pop(id_hash, None)
+        if data is not None:
+            self.size -= len(data)
+
+    def fits(self, size):
+        return size <= self.max_size
+
+    async def load(self, id_hash, path):
+        """
+        Returns:
+            bytes: The pack, from memory or read from path and kept in memory
+        """
+        data = self.get(id_hash)
+        if data is not None:
+            self.hits += 1
+            return data
+        self.misses += 1
+
+        loading = self.loading.get(id_hash)
+        if loading is None:
+            loading = asyncio.get_running_loop().run_in_executor(None, read_file, path)
+            self.loading[id_hash] = loading
+            loading.add_done_callback(lambda future: self.loaded(id_hash, future))
+        # a download that is cancelled doesn't cancel the read for the others
+        return await asyncio.shield(loading)
+
+    def loaded(self, id_hash, future):
+        del self.loading[id_hash]
+        if not future.cancelled() and future.exception() is None:
+            self.put(id_hash, future.result())
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "packs": len(self.packs),
+            "size": self.size,
+            "max_size": self.max_size,
+        }
@@ -0,0 +1,72 @@
+import collections
+import time
+
+# Why uploads are rejected, counted on /stats
+REJECTIONS = ("ip", "agent", "key", "busy", "ip_rate", "key_rate")
+
+
+class TokenBuckets:
+    """
+    A token bucket for each key: a key can make burst requests at once, then
+    gets per_minute of them back every minute.
+
+    Args:
+        burst (int): Tokens of a full bucket
+        per_minute (float): Tokens added back every minute, 0 disables the limit
+        max_keys (int): Buckets kept, the least recently used are dropped past that
+    """
+
+    def __init__(self, burst, per_minute, max_keys=10000):
+        self.burst = burst
+        self.rate = per_minute / 60
+        self.max_keys = max_keys
+        # key: (tokens, time they were counted), the least recently used first
+        self.buckets = collections.OrderedDict()
+
+    def take(self, key):
+        """
+        Returns:
+            float: 0 if a token was taken, else the seconds until one is available
+        """
+        if not self.rate:
+            return 0
+        now = time.monotonic()
+        tokens, last = self.buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        wait = 0
+        if tokens < 1:
+            wait = (1 - tokens) / self.rate
+        else:
+            tokens -= 1
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        return wait
+
+
+class UploadLimits:
+    """
+    Admission control of uploads: how many are handled at once, from
+    receiving the pack to its conversion, and how often a key or an IP can
+    upload. Rejections are counted by reason.
+
+    Args:
+        config (dict): The [limits] section of the settings
+    """
+
+    def __init__(self, config):
+        self.max_uploads = config["max_uploads"]
+        self.retry_after = config["retry_after"]
+        self.keys = TokenBuckets(config["key_burst"], config["key_per_minute"])
+        self.ips = TokenBuckets(config["ip_burst"], config["ip_per_minute"])
+        self.in_flight = 0
+        self.rejected = dict.fromkeys(REJECTIONS, 0)
+
+    def full(self):
+        return bool(self.max_uploads) and self.in_flight >= self.max_uploads
+
+    def reject(self, reason):
+        self.rejected[reason] += 1
+
+    def stats(self):
+        return {"in_flight": self.in_flight, "rejected": dict(self.rejected)}
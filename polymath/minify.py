@@ -0,0 +1,87 @@
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Entries re-serialized by the minify stage
+EXTENSIONS = (".json", ".mcmeta")
+
+
+def minify_json(data):
+    """
+    Re-serializes a JSON document without whitespace. orjson is used when
+    it is installed and can handle the document, json otherwise.
+
+    Args:
+        data (bytes): The JSON document
+
+    Returns:
+        bytes: The minified document, or None if it isn't valid JSON or isn't smaller
+    """
+    minified = None
+    if orjson is not None:
+        try:
+            minified = orjson.dumps(orjson.loads(data))
+        except (orjson.JSONDecodeError, orjson.JSONEncodeError):
+            # NaN, integers over 64 bits... the json module is more lenient
+            pass
+    if minified is None:
+        try:
+            parsed = json.loads(data.decode("utf-8"))
+            minified = json.dumps(parsed, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+        except ValueError:
+            return None
+    if len(minified) >= len(data):
+        return None
+    return minified
+
+
+def minify_tree(tree):
+    """
+    Minifies the JSON entries of a PackTree in place.
+
+    Args:
+        tree (PackTree): The resource pack
+
+    Returns:
+        int: Bytes saved
+    """
+    saved = 0
+    for name in list(tree):
+        if not name.lower().endswith(EXTENSIONS):
+            continue
+        data = tree[name]
+        minified = minify_json(data)
+        if minified is not None:
+            tree[name] = minified
+            saved += len(data) - len(minified)
+    return saved
+
+
+def minify_directory(folder):
+    """
+    Minifies the JSON files of an extracted resource pack in place.
+
+    Args:
+        folder (str): The extracted resource pack
+
+    Returns:
+        int: Bytes saved
+    """
+    saved = 0
+    for root, dirs, files in os.walk(folder):
+        for file in files:
+            if not file.lower().endswith(EXTENSIONS):
+                continue
+            path = os.path.join(root, file)
+            with open(path, "rb") as f:
+                data = f.read()
+            minified = minify_json(data)
+            if minified is not None:
+                with open(path, "wb") as f:
+                    f.write(minified)
+                saved += len(data) - len(minified)
+    return saved
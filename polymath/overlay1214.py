@@ -27,29 +27,58 @@ def overlay1214(target_dir, overlay_1214):
     shutil.copytree(overlay_1214, os.path.join(target_dir, "overlay_1_21_4"), dirs_exist_ok=True)
 
     with open(mcmeta_path, "r+") as mcmeta_file:
-        mcmeta_data = json.load(mcmeta_file)
+        mcmeta_data = add_overlay_entry(json.load(mcmeta_file))
+        mcmeta_file.seek(0)
+        json.dump(mcmeta_data, mcmeta_file, indent=4)
+        mcmeta_file.truncate()
+
+
+def overlay1214_tree(target_tree, overlay_tree):
+    """
+    Add an overlay for 1.21.4+ format to a resource pack held in a PackTree.
 
-        if mcmeta_data.get("pack") is None:
-            raise ValueError("pack key not found in pack.mcmeta")
-        
-        if mcmeta_data["pack"].get("pack_format") is None:
-            raise ValueError("pack_format key not found in pack.mcmeta")
-        
-        mcmeta_data["pack"]["supported_formats"] = [mcmeta_data["pack"]["pack_format"], 99]
-        if mcmeta_data["pack"]["pack_format"] < 16:
-            mcmeta_data["pack"]["pack_format"] = 16
+    Args:
+        target_tree (PackTree): The resource pack.
+        overlay_tree (PackTree): The files to be used as overlay.
+    """
+    if "pack.mcmeta" not in target_tree:
+        raise FileNotFoundError("pack.mcmeta file does not exist.")
 
-        if mcmeta_data.get("overlays") is None:
-            mcmeta_data["overlays"] = {}
+    for name in list(overlay_tree):
+        target_tree["overlay_1_21_4/" + name] = overlay_tree[name]
 
-        if mcmeta_data["overlays"].get("entries") is None:
-            mcmeta_data["overlays"]["entries"] = []
+    mcmeta_data = add_overlay_entry(json.loads(target_tree["pack.mcmeta"].decode("utf-8")))
+    target_tree["pack.mcmeta"] = json.dumps(mcmeta_data, indent=4).encode("utf-8")
 
-        mcmeta_data["overlays"]["entries"].append({
-            "directory": "overlay_1_21_4",
-            "formats": [44, 99]
-        })
 
-        mcmeta_file.seek(0)
-        json.dump(mcmeta_data, mcmeta_file, indent=4)
-        mcmeta_file.truncate()
\ No newline at end of file
+def add_overlay_entry(mcmeta_data):
+    """
+    Declares the 1.21.4+ overlay in the parsed pack.mcmeta.
+
+    Args:
+        mcmeta_data (dict): The parsed pack.mcmeta, modified in place.
+
+    Returns:
+        dict: mcmeta_data
+    """
+    if mcmeta_data.get("pack") is None:
+        raise ValueError("pack key not found in pack.mcmeta")
+
+    if mcmeta_data["pack"].get("pack_format") is None:
+        raise ValueError("pack_format key not found in pack.mcmeta")
+
+    mcmeta_data["pack"]["supported_formats"] = [mcmeta_data["pack"]["pack_format"], 99]
+    if mcmeta_data["pack"]["pack_format"] < 16:
+        mcmeta_data["pack"]["pack_format"] = 16
+
+    if mcmeta_data.get("overlays") is None:
+        mcmeta_data["overlays"] = {}
+
+    if mcmeta_data["overlays"].get("entries") is None:
+        mcmeta_data["overlays"]["entries"] = []
+
+    mcmeta_data["overlays"]["entries"].append({
+        "directory": "overlay_1_21_4",
+        "formats": [44, 99]
+    })
+    return mcmeta_data
\ No newline at end of file
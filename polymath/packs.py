@@ -1,9 +1,131 @@
-from polymath import utils, dmgzipext, dmgzipgen, converter, overlay1214
-import hashlib
+from polymath import utils, dmgzipext, dmgzipgen, converter, overlay1214, minify, pngopt, workers
+from polymath.conversions import ConversionCache
+from polymath.downloads import DownloadTracker
+from polymath.registry import Registry
+from polymath.hotcache import HotPackCache
+from polymath.packtree import PackTree
+from polymath.stats import PipelineStats
+import logging
+import mmap
 import time
 import os
+import shutil
 import tempfile
 
+
+def stored_path(packs_folder, id_hash):
+    """
+    Packs are spread over subfolders named after the first two characters
+    of their id, so no folder ends up with hundreds of thousands of files.
+    """
+    return os.path.join(packs_folder, id_hash[:2], id_hash)
+
+
+def build_pack(pack_path, packs_folder, settings, png_cache=None):
+    """
+    Runs the whole conversion pipeline on an uploaded pack and stores the result.
+    Meant to run in a worker process, it doesn't touch the registry.
+
+    Args:
+        pack_path (str): Path of the uploaded resource pack
+        packs_folder (str): Folder where the converted pack is stored
+        settings (dict): The [pipeline] section of the settings
+        png_cache (pngopt.PngCache): Cache of the PNG optimization stage
+
+    Returns:
+        tuple: (SHA1 of the stored pack used as its id, PipelineStats of the conversion)
+    """
+    stats = PipelineStats()
+    with open(pack_path, "rb") as pack_file:
+        # not closed explicitly, it is unmapped once the last view of it is gone
+        pack = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        mangled_path = os.path.join(temp_dir, "pack_mangled.zip")
+        with open(mangled_path, "wb") as mangled_file:
+            writer = dmgzipgen.MangledZipWriter(
+                mangled_file,
+                dmgzipgen.CompressionPolicy.from_config(settings["compression"]),
+                settings["threads"],
+                settings["dedup"],
+            )
+            if settings["in_memory"]:
+                id_hash = convert_in_memory(pack, writer, settings, stats, png_cache)
+            else:
+                id_hash = convert_on_disk(pack, writer, temp_dir, settings, stats, png_cache)
+
+        output = stored_path(packs_folder, id_hash)
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        shutil.move(mangled_path, output)
+
+    return id_hash, stats
+
+
+def optimize_pngs(pack, optimize, files, settings, stats, png_cache):
+    """
+    Runs the PNG optimization stage, if it is enabled for a pack of that size.
+    optimize is pngopt.optimize_tree or pngopt.optimize_directory, files what it optimizes.
+    """
+    if not settings["enabled"] or len(pack) > settings["max_pack_size"]:
+        return
+    with stats.stage("png") as stage:
+        optimized, saved, hits = optimize(files, settings, png_cache)
+        stage.count("entries", optimized)
+        stage.count("bytes_saved", saved)
+        stage.count("cache_hits", hits)
+
+
+def convert_on_disk(pack, writer, temp_dir, settings, stats, png_cache=None):
+    extpackdir = os.path.join(temp_dir, "pack")
+    overlay1214dir = os.path.join(temp_dir, "overlay")
+    os.mkdir(extpackdir)
+    with stats.stage("extract") as stage:
+        files, size = dmgzipext.extract_damaged_zip_buf(pack, extpackdir, settings["threads"])
+        stage.count("bytes_in", len(pack))
+        stage.count("entries", files)
+        stage.count("bytes_out", size)
+    optimize_pngs(pack, pngopt.optimize_directory, extpackdir, settings["png"], stats, png_cache)
+    with stats.stage("convert") as stage:
+        stage.count("entries", converter.convert_resource_pack(
+            extpackdir, overlay1214dir, settings["convert_processes"], settings["convert_chunk_size"]
+        ))
+        overlay1214.overlay1214(extpackdir, overlay1214dir)
+    if settings["minify"]:
+        with stats.stage("minify") as stage:
+            stage.count("bytes_saved", minify.minify_directory(extpackdir))
+    with stats.stage("zip") as stage:
+        writer.write_directory(extpackdir)
+        return close_writer(writer, stage)
+
+
+def convert_in_memory(pack, writer, settings, stats, png_cache=None):
+    with PackTree(settings["spill_size"]) as tree, PackTree(settings["spill_size"]) as overlay:
+        with stats.stage("extract") as stage:
+            stage.count("bytes_in", len(pack))
+            stage.count("entries", dmgzipext.extract_damaged_zip_tree(pack, tree))
+        optimize_pngs(pack, pngopt.optimize_tree, tree, settings["png"], stats, png_cache)
+        with stats.stage("convert") as stage:
+            stage.count("entries", converter.convert_resource_tree(
+                tree, overlay, settings["convert_processes"], settings["convert_chunk_size"]
+            ))
+            overlay1214.overlay1214_tree(tree, overlay)
+        if settings["minify"]:
+            with stats.stage("minify") as stage:
+                stage.count("bytes_saved", minify.minify_tree(tree))
+        with stats.stage("zip") as stage:
+            writer.write_tree(tree, settings["passthrough"])
+            return close_writer(writer, stage)
+
+
+def close_writer(writer, stage):
+    """Closes the writer of the converted pack and counts what it wrote on stage."""
+    id_hash = writer.close()
+    stage.count("entries", len(writer.entries))
+    stage.count("bytes_out", writer.fileobj.tell())
+    stage.count("bytes_deduplicated", writer.deduplicated)
+    return id_hash
+
+
 class PacksManager:
     def __init__(self, config):
         self.config = config
@@ -11,40 +133,127 @@ class PacksManager:
         if not os.path.exists(self.folder):
             os.mkdir(self.folder)
         self.packs_folder = self.folder + "packs/"
-        self.registry = utils.SavedDict(self.folder + "registry.json")
+        self.uploads_folder = self.folder + "uploads/"
+        self.png_cache = pngopt.PngCache(self.folder + "pngcache/")
+        self.hot_packs = HotPackCache(config["cache"]["hot_packs"])
+        self.registry = Registry(self.folder + "registry.db")
+        self.downloads = DownloadTracker(self.registry)
+        self.conversions = ConversionCache(self.registry, config["cache"]["conversions"], config["pipeline"])
         if not os.path.exists(self.packs_folder):
             os.mkdir(self.packs_folder)
+        self.migrate_flat_packs()
+        filled = self.registry.fill_sizes(self.pack_path)
+        if filled:
+            logging.info("Set the size of " + str(filled) + " packs registered without one")
+        # uploads left over by a crash are never picked up again
+        shutil.rmtree(self.uploads_folder, ignore_errors=True)
+        os.mkdir(self.uploads_folder)
+        self.workers = None
+
+    def pack_path(self, id_hash):
+        return stored_path(self.packs_folder, id_hash)
+
+    def migrate_flat_packs(self):
+        """Moves the packs stored directly in the packs folder by previous versions to their subfolder."""
+        moved = 0
+        with os.scandir(self.packs_folder) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    os.makedirs(os.path.dirname(self.pack_path(entry.name)), exist_ok=True)
+                    os.replace(entry.path, self.pack_path(entry.name))
+                    moved += 1
+        if moved:
+            logging.info("Moved " + str(moved) + " packs to the subfolders of " + self.packs_folder)
+
+    def start_workers(self):
+        self.workers = workers.WorkerPool(self.config["workers"], modules=("polymath.packs",))
 
-    def register(self, pack, spigot_id, ip):
-        with tempfile.TemporaryDirectory() as temp_dir:
-            extpackdir = os.path.join(temp_dir, "pack")
-            overlay1214dir = os.path.join(temp_dir, "overlay")
-            os.mkdir(extpackdir)
-            dmgzipext.extract_damaged_zip_buf(pack, extpackdir)
-            converter.convert_resource_pack(extpackdir, overlay1214dir)
-            overlay1214.overlay1214(extpackdir, overlay1214dir)
-            dmgzipgen.create_valid_zip_from_directory(extpackdir, os.path.join(temp_dir, "pack.zip"))
-            dmgzipgen.mangle_zip_file(os.path.join(temp_dir, "pack.zip"), os.path.join(temp_dir, "pack_mangled.zip"))
-            with open(os.path.join(temp_dir, "pack_mangled.zip"), "rb") as f:
-                pack = f.read()
-
-        sha1 = hashlib.sha1()
-        sha1.update(pack)
-        id_hash = sha1.hexdigest()
-
-        with open(os.path.join(self.packs_folder, id_hash), "wb") as pack_file:
-            pack_file.write(pack)
+    async def register_async(self, pack_path, spigot_id, ip, digest=None):
+        """
+        Converts an uploaded pack in the worker pool, unless the same upload
+        was converted already, and registers it.
+        See WorkerPool.run for the exceptions raised when it is busy or a job fails.
 
+        Returns:
+            tuple: (id_hash, PipelineStats of the conversion, None if the cached pack was reused)
+        """
+        id_hash = self.cached(digest)
+        stats = None
+        if id_hash is None:
+            id_hash, stats = await self.workers.run(
+                build_pack, pack_path, self.packs_folder, self.config["pipeline"], self.png_cache
+            )
+            self.converted(id_hash, stats, digest, spigot_id, ip)
+        else:
+            self.record(id_hash, spigot_id, ip, self.registry[id_hash].get("deduplicated", 0))
+        return id_hash, stats
+
+    def cached(self, digest):
+        """
+        Args:
+            digest (str): SHA256 of the uploaded pack, None skips the cache
+
+        Returns:
+            str: Id of the stored pack already converted from that upload, or None
+        """
+        if digest is None:
+            return None
+        id_hash = self.conversions.get(digest)
+        if id_hash is None:
+            return None
+        if id_hash not in self.registry or not os.path.exists(self.pack_path(id_hash)):
+            self.conversions.discard(digest)
+            return None
+        logging.debug("Reusing pack "+id_hash+" converted from "+digest)
+        return id_hash
+
+    def converted(self, id_hash, stats, digest, spigot_id, ip):
+        """Logs the stats of a pack built from an upload, remembers and records it."""
+        stats.log(
+            "Converted pack " + id_hash + " for " + str(spigot_id) + " from " + str(ip) + ": ",
+            self.config["extra"]["stats_level"],
+            self.config["extra"]["stage_stats_level"],
+        )
+        if digest is not None:
+            self.conversions.put(digest, id_hash)
+        self.record(id_hash, spigot_id, ip, stats.counter("bytes_deduplicated"))
+
+    def record(self, id_hash, spigot_id, ip, deduplicated=0):
         self.registry[id_hash] = {
             "id": spigot_id,
             "ip": ip,
             "last_download": int(time.time()),
+            # bytes saved by storing identical files once
+            "deduplicated": deduplicated,
+            "downloads": self.registry.get(id_hash, {}).get("downloads", 0),
+            # packs never change, HEAD and metadata requests are answered without the file
+            "size": os.path.getsize(self.pack_path(id_hash)),
         }
 
-        return id_hash
+    def info(self, id_hash):
+        """
+        Returns:
+            dict: The registry entry of the pack, with its size, or None if it isn't registered
+        """
+        entry = self.registry.get(id_hash)
+        if entry is None:
+            return None
+        if "size" not in entry:
+            # registered before sizes were recorded
+            try:
+                entry["size"] = os.path.getsize(self.pack_path(id_hash))
+            except OSError:
+                return None
+        return entry
 
     def fetch(self, id_hash):
-        output = os.path.join(self.packs_folder, id_hash)
-        if id_hash in self.registry and os.path.exists(output):
-            self.registry[id_hash]["last_download"] = time.time()
-            return output
\ No newline at end of file
+        """
+        Records a download of a pack, the registry is updated by the next flush of the tracker.
+        The file isn't checked, the cleaner removes packs from the registry before their file.
+
+        Returns:
+            str: Path of the pack, or None if it isn't registered
+        """
+        if id_hash in self.registry:
+            self.downloads.hit(id_hash)
+            return self.pack_path(id_hash)
@@ -0,0 +1,134 @@
+import os
+import shutil
+import tempfile
+import zlib
+import collections.abc
+
+
+class Entry:
+    """
+    A single file of a PackTree.
+
+    Entries read from an archive keep their compressed bytes and are only
+    inflated when read, entries written by the pipeline keep their bytes
+    in memory or in a spill file.
+    """
+
+    __slots__ = ("data", "method", "path")
+
+    def __init__(self, data=None, method=None, path=None):
+        self.data = data
+        self.method = method
+        self.path = path
+
+    def read(self):
+        if self.path is not None:
+            with open(self.path, "rb") as spill_file:
+                return spill_file.read()
+        if self.method == 8:
+            return zlib.decompress(self.data, -15)
+        if self.method is not None:
+            return bytes(self.data)
+        return self.data
+
+
+class PackTree(collections.abc.MutableMapping):
+    """
+    In-memory representation of a resource pack, maps archive paths
+    ("assets/minecraft/models/item/bow.json") to file contents.
+
+    Args:
+        spill_size (int): Once the pipeline wrote that many bytes, new files
+                          are spilled to a temporary directory. 0 never spills.
+    """
+
+    def __init__(self, spill_size=0):
+        self.entries = {}
+        self.spill_size = spill_size
+        self.memory_size = 0
+        self.spill_dir = None
+        self.spill_count = 0
+
+    def add_compressed(self, name, method, data):
+        """
+        Adds a file read from an archive without inflating it.
+
+        Args:
+            name (str): Path of the file in the pack
+            method (int): Zip compression method of data, 0 (stored) or 8 (deflate)
+            data (bytes-like): The compressed file, a memoryview avoids copies
+        """
+        self.drop(name)
+        self.entries[name] = Entry(data=data, method=method)
+
+    def compressed(self, name):
+        """
+        Args:
+            name (str): Path of the file in the pack
+
+        Returns:
+            bytes-like: The original deflate stream of the file, None if it was
+                        stored or written by the pipeline
+        """
+        entry = self.entries[name]
+        if entry.path is None and entry.method == 8:
+            return entry.data
+        return None
+
+    def drop(self, name):
+        entry = self.entries.pop(name, None)
+        if entry is None:
+            return
+        if entry.path is not None:
+            os.remove(entry.path)
+        elif entry.method is None:
+            self.memory_size -= len(entry.data)
+
+    def spill(self, data):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="polymath-")
+        path = os.path.join(self.spill_dir, str(self.spill_count))
+        self.spill_count += 1
+        with open(path, "wb") as spill_file:
+            spill_file.write(data)
+        return path
+
+    def __getitem__(self, name):
+        return self.entries[name].read()
+
+    def __setitem__(self, name, data):
+        self.drop(name)
+        if self.spill_size and self.memory_size + len(data) > self.spill_size:
+            self.entries[name] = Entry(path=self.spill(data))
+        else:
+            self.entries[name] = Entry(data=bytes(data))
+            self.memory_size += len(data)
+
+    def __delitem__(self, name):
+        if name not in self.entries:
+            raise KeyError(name)
+        self.drop(name)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def move(self, src, dst):
+        """Renames a file without reading it."""
+        self.drop(dst)
+        self.entries[dst] = self.entries.pop(src)
+
+    def close(self):
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+        self.entries = {}
+        self.memory_size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
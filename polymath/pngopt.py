@@ -0,0 +1,375 @@
+import hashlib
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Bump this when optimize_png changes what it produces, the cached results are ignored then
+PNGOPT_VERSION = 1
+
+# Chunks kept in optimized PNGs, tRNS is ancillary but changes the pixels
+KEPT_CHUNKS = (b'IHDR', b'PLTE', b'tRNS', b'IDAT', b'IEND')
+# Channels per pixel of each color type
+CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+# Cost of a filtered byte for the filter heuristic: its distance to 0 as a signed byte
+FILTER_COST = bytes(v if v < 128 else 256 - v for v in range(256))
+# (first column, first row, column step, row step) of the 7 passes of Adam7 interlacing
+ADAM7 = ((0, 0, 8, 8), (4, 0, 8, 8), (0, 4, 4, 8), (2, 0, 4, 4), (0, 2, 2, 4), (1, 0, 2, 2), (0, 1, 1, 2))
+
+
+class TimeBudgetExceeded(Exception):
+    """Raised when optimize_png runs past its deadline."""
+
+
+def check_deadline(deadline):
+    if deadline is not None and time.monotonic() > deadline:
+        raise TimeBudgetExceeded()
+
+
+def read_chunks(data):
+    """
+    Splits a PNG file in chunks.
+
+    Args:
+        data (bytes): The PNG file
+
+    Returns:
+        list: (chunk type, chunk data) tuples
+
+    Raises:
+        ValueError: If data isn't a well formed PNG
+    """
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError("not a PNG")
+    chunks = []
+    pos = 8
+    while pos + 8 <= len(data):
+        length, chunk_type = struct.unpack_from('>I4s', data, pos)
+        chunk_data = bytes(data[pos + 8:pos + 8 + length])
+        if len(chunk_data) != length:
+            raise ValueError("truncated chunk")
+        chunks.append((chunk_type, chunk_data))
+        pos += 12 + length
+        if chunk_type == b'IEND':
+            return chunks
+    raise ValueError("missing IEND")
+
+
+def write_chunk(chunk_type, chunk_data):
+    crc = zlib.crc32(chunk_data, zlib.crc32(chunk_type))
+    return struct.pack('>I4s', len(chunk_data), chunk_type) + chunk_data + struct.pack('>I', crc)
+
+
+def paeth(a, b, c):
+    p = a + b - c
+    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    if pb <= pc:
+        return b
+    return c
+
+
+def filtered_size(width, height, bits_per_pixel, interlace):
+    """
+    Returns:
+        int: Size of the decompressed image data, a filter byte and the pixels of each scanline
+    """
+    if not interlace:
+        return height * (1 + (width * bits_per_pixel + 7) // 8)
+    size = 0
+    for x, y, dx, dy in ADAM7:
+        pass_width = (width - x + dx - 1) // dx
+        pass_height = (height - y + dy - 1) // dy
+        if pass_width and pass_height:
+            size += pass_height * (1 + (pass_width * bits_per_pixel + 7) // 8)
+    return size
+
+
+def unfilter(data, row_bytes, height, bpp, deadline=None):
+    """
+    Reverses the filters of the scanlines of a non interlaced image.
+
+    Returns:
+        list: The raw scanlines, as bytearrays
+
+    Raises:
+        TimeBudgetExceeded: If the deadline (a time.monotonic value) is reached
+    """
+    rows = []
+    prev = bytearray(row_bytes)
+    pos = 0
+    for _ in range(height):
+        check_deadline(deadline)
+        filter_type = data[pos]
+        row = bytearray(data[pos + 1:pos + 1 + row_bytes])
+        pos += 1 + row_bytes
+        if len(row) != row_bytes:
+            raise ValueError("truncated image data")
+        if filter_type == 1:
+            for i in range(bpp, row_bytes):
+                row[i] = (row[i] + row[i - bpp]) & 0xFF
+        elif filter_type == 2:
+            row = bytearray((a + b) & 0xFF for a, b in zip(row, prev))
+        elif filter_type == 3:
+            for i in range(row_bytes):
+                left = row[i - bpp] if i >= bpp else 0
+                row[i] = (row[i] + ((left + prev[i]) >> 1)) & 0xFF
+        elif filter_type == 4:
+            for i in range(row_bytes):
+                if i >= bpp:
+                    row[i] = (row[i] + paeth(row[i - bpp], prev[i], prev[i - bpp])) & 0xFF
+                else:
+                    row[i] = (row[i] + prev[i]) & 0xFF
+        elif filter_type != 0:
+            raise ValueError("unknown filter type " + str(filter_type))
+        rows.append(row)
+        prev = row
+    return rows
+
+
+def filter_row(row, prev, bpp):
+    """
+    Returns:
+        bytes: The filter type byte and the row filtered with the cheapest of the five filters
+    """
+    left = bytes(bpp) + bytes(row[:-bpp])
+    up_left = bytes(bpp) + bytes(prev[:-bpp])
+    candidates = (
+        b'\x00' + bytes(row),
+        b'\x01' + bytes((a - b) & 0xFF for a, b in zip(row, left)),
+        b'\x02' + bytes((a - b) & 0xFF for a, b in zip(row, prev)),
+        b'\x03' + bytes((a - ((b + c) >> 1)) & 0xFF for a, b, c in zip(row, left, prev)),
+        b'\x04' + bytes((a - paeth(b, c, d)) & 0xFF for a, b, c, d in zip(row, left, prev, up_left)),
+    )
+    return min(candidates, key=lambda filtered: sum(filtered[1:].translate(FILTER_COST)))
+
+
+def deflate(data, deadline=None):
+    """Smallest of the zlib streams of data at level 9 with the default and the filtered strategy."""
+    best = None
+    for strategy in (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED):
+        check_deadline(deadline)
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+        compressed = compressor.compress(data) + compressor.flush()
+        if best is None or len(compressed) < len(best):
+            best = compressed
+    return best
+
+
+def optimize_png(data, max_pixels=0, deadline=None):
+    """
+    Losslessly re-encodes a PNG: ancillary chunks other than tRNS are
+    stripped (Minecraft ignores them), the scanlines are filtered again with
+    the best filter of each row and IDAT is deflated at the maximum level.
+
+    Interlaced images keep their filters, their data is only deflated again.
+    Animated PNGs, PNGs with unknown critical chunks and images over
+    max_pixels are left as they are.
+
+    Args:
+        data (bytes): The PNG file
+        max_pixels (int): Images with more pixels are left as they are, 0 for no limit
+        deadline (float): time.monotonic value the optimization gives up at, checked on every row
+
+    Returns:
+        bytes: The optimized PNG, or None if it isn't smaller than data
+
+    Raises:
+        ValueError: If data isn't a valid PNG
+        TimeBudgetExceeded: If the deadline is reached
+    """
+    chunks = read_chunks(data)
+    if chunks[0][0] != b'IHDR':
+        raise ValueError("IHDR isn't the first chunk")
+    for chunk_type, _ in chunks:
+        if chunk_type == b'acTL' or (chunk_type not in KEPT_CHUNKS and chunk_type[0:1].isupper()):
+            return None
+
+    ihdr = chunks[0][1]
+    width, height, bit_depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', ihdr)
+    if color_type not in CHANNELS:
+        raise ValueError("unknown color type " + str(color_type))
+    if max_pixels and width * height > max_pixels:
+        return None
+    bits_per_pixel = CHANNELS[color_type] * bit_depth
+    row_bytes = (width * bits_per_pixel + 7) // 8
+    expected = filtered_size(width, height, bits_per_pixel, interlace)
+    decompressor = zlib.decompressobj()
+    # bounded, a small crafted PNG could inflate to gigabytes, one byte more tells if there is trailing data
+    filtered = decompressor.decompress(
+        b''.join(chunk_data for chunk_type, chunk_data in chunks if chunk_type == b'IDAT'), expected + 1
+    )
+    if not decompressor.eof or decompressor.unconsumed_tail or len(filtered) != expected:
+        # trailing or missing data, decoders deal with it in their own way
+        return None
+
+    candidates = [filtered]
+    if not interlace:
+        bpp = max(1, bits_per_pixel // 8)
+        rows = unfilter(filtered, row_bytes, height, bpp, deadline)
+        # the spec recommends no filter for palette and low bit depth images, the heuristic is tried anyway
+        candidates.append(b''.join(b'\x00' + bytes(row) for row in rows))
+        prev = bytes(row_bytes)
+        adaptive = []
+        for row in rows:
+            check_deadline(deadline)
+            adaptive.append(filter_row(row, prev, bpp))
+            prev = row
+        candidates.append(b''.join(adaptive))
+
+    idat = min((deflate(candidate, deadline) for candidate in candidates), key=len)
+    output = [PNG_SIGNATURE]
+    for chunk_type, chunk_data in chunks:
+        if chunk_type == b'IDAT':
+            if idat is not None:
+                output.append(write_chunk(b'IDAT', idat))
+                idat = None
+        elif chunk_type in KEPT_CHUNKS:
+            output.append(write_chunk(chunk_type, chunk_data))
+    output = b''.join(output)
+    if len(output) >= len(data):
+        return None
+    return output
+
+
+class PngCache:
+    """
+    Results of optimize_png kept on disk, keyed by the SHA1 of the input PNG.
+    Shared by the worker processes, entries are written atomically.
+
+    Args:
+        folder (str): Folder of the cache, created if needed
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def key(self, data):
+        sha1 = hashlib.sha1(data)
+        sha1.update(b'%d' % PNGOPT_VERSION)
+        return sha1.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.folder, key[:2], key)
+
+    def get(self, key):
+        """
+        Returns:
+            bytes: The optimized PNG, b'' if it couldn't be made smaller, None if unknown
+        """
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        # the mtime tells trim which entries were used last
+        os.utime(self.path(key))
+        return data
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def trim(self, max_size):
+        """Removes the least recently used entries until the cache is under max_size bytes."""
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.folder):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def optimize_files(files, settings, cache=None):
+    """
+    Optimizes PNG files with optimize_png, reusing the results of the cache.
+    Once the time budget is spent, even in the middle of an image, only the
+    cached results are used.
+
+    Args:
+        files (iterable): (read, write) tuples, read() returns the file
+                          and write(data) replaces it
+        settings (dict): The [pipeline.png] section of the settings
+        cache (PngCache): Where results are looked up and saved, None disables it
+
+    Returns:
+        tuple: (number of optimized files, bytes saved, cache hits)
+    """
+    deadline = time.monotonic() + settings["time_budget"]
+    optimized, saved, hits = 0, 0, 0
+    for read, write in files:
+        data = read()
+        key = cache.key(data) if cache is not None else None
+        output = cache.get(key) if cache is not None else None
+        if output is not None:
+            hits += 1
+        elif time.monotonic() < deadline:
+            try:
+                output = optimize_png(data, settings["max_pixels"], deadline) or b''
+            except TimeBudgetExceeded:
+                # not cached, the image may be optimized by a later upload
+                continue
+            except (ValueError, struct.error, zlib.error):
+                # not a PNG we can read, the client will deal with it
+                output = b''
+            if cache is not None:
+                cache.put(key, output)
+        if output:
+            write(output)
+            optimized += 1
+            saved += len(data) - len(output)
+    return optimized, saved, hits
+
+
+def optimize_tree(tree, settings, cache=None):
+    """optimize_files on the PNGs of a PackTree."""
+    def file(name):
+        def write(data):
+            tree[name] = data
+
+        return lambda: tree[name], write
+
+    return optimize_files((file(name) for name in list(tree) if name.lower().endswith('.png')), settings, cache)
+
+
+def optimize_directory(folder, settings, cache=None):
+    """optimize_files on the PNGs of an extracted resource pack."""
+    def file(path):
+        def read():
+            with open(path, 'rb') as f:
+                return f.read()
+
+        def write(data):
+            with open(path, 'wb') as f:
+                f.write(data)
+
+        return read, write
+
+    paths = []
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            if name.lower().endswith('.png'):
+                paths.append(os.path.join(root, name))
+    return optimize_files((file(path) for path in paths), settings, cache)
@@ -0,0 +1,180 @@
+import collections.abc
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+
+class Registry(collections.abc.MutableMapping):
+    """
+    The registry of the packs, id of a pack to its entry, stored in SQLite.
+    Each change is one small transaction appended to the write-ahead log
+    instead of a rewrite of the whole registry, and opening it doesn't read
+    it. last_download is indexed, so the packs to expire are found without
+    going through every entry, and the size of each pack is a column, so the
+    size of the storage is known without reading the entries.
+
+    A registry.json left by a previous version is imported on first start.
+
+    Args:
+        file_name (str): The database file
+    """
+
+    def __init__(self, file_name):
+        self.file = file_name
+        # the cleaner uses it from an executor thread
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # a crash can lose the last transactions but never corrupts the database
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS packs ("
+                "id TEXT PRIMARY KEY, last_download REAL NOT NULL, entry TEXT NOT NULL, size INTEGER NOT NULL DEFAULT 0)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS packs_last_download ON packs (last_download)")
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(packs)")]
+            if "size" not in columns:
+                # created before the size column
+                self.connection.execute("ALTER TABLE packs ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+                rows = self.connection.execute("SELECT id, entry FROM packs").fetchall()
+                self.connection.executemany(
+                    "UPDATE packs SET size = ? WHERE id = ?",
+                    [(json.loads(entry).get("size", 0), id_hash) for id_hash, entry in rows],
+                )
+        self.migrate(os.path.splitext(file_name)[0] + ".json")
+
+    def migrate(self, json_file):
+        """Imports the entries of the JSON registry and renames it so it isn't imported again."""
+        if not os.path.isfile(json_file):
+            return
+        with open(json_file, "r") as f:
+            entries = json.load(f)
+        self.update_many(entries)
+        os.replace(json_file, json_file + ".migrated")
+        logging.info("Imported " + str(len(entries)) + " packs from " + json_file)
+
+    def fill_sizes(self, pack_path):
+        """
+        Sets the size of the packs registered without one, by a version
+        without the size column or in registry.json, from their file, so
+        max_storage applies right after an upgrade.
+
+        Args:
+            pack_path (callable): Path of the file of a pack from its id
+
+        Returns:
+            int: Packs whose size was set
+        """
+        with self.lock, self.connection:
+            rows = self.connection.execute("SELECT id, entry FROM packs WHERE size = 0").fetchall()
+            updates = []
+            for id_hash, entry in rows:
+                try:
+                    size = os.path.getsize(pack_path(id_hash))
+                except OSError:
+                    continue  # no file, the reconciler removes it
+                entry = json.loads(entry)
+                entry["size"] = size
+                updates.append((size, json.dumps(entry), id_hash))
+            self.connection.executemany("UPDATE packs SET size = ?, entry = ? WHERE id = ?", updates)
+        return len(updates)
+
+    def __getitem__(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT entry FROM packs WHERE id = ?", (str(key),)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value):
+        self.update_many({key: value})
+
+    def update_many(self, items):
+        """Sets every key of items in one transaction."""
+        rows = [
+            (str(key), value["last_download"], json.dumps(value), value.get("size", 0)) for key, value in items.items()
+        ]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO packs (id, last_download, entry, size) VALUES (?, ?, ?, ?)", rows
+            )
+
+    def update_existing(self, items):
+        """
+        Sets the keys of items that are still registered in one transaction.
+        Unlike update_many, a pack the cleaner removed in between isn't added back.
+
+        Returns:
+            int: Packs updated
+        """
+        rows = [
+            (value["last_download"], json.dumps(value), value.get("size", 0), str(key)) for key, value in items.items()
+        ]
+        with self.lock, self.connection:
+            return self.connection.executemany(
+                "UPDATE packs SET last_download = ?, entry = ?, size = ? WHERE id = ?", rows
+            ).rowcount
+
+    def __delitem__(self, key):
+        with self.lock, self.connection:
+            deleted = self.connection.execute("DELETE FROM packs WHERE id = ?", (str(key),)).rowcount
+        if not deleted:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM packs WHERE id = ?", (str(key),)).fetchone() is not None
+
+    def __iter__(self):
+        # fetched at once, the registry can change while the ids are used
+        with self.lock:
+            rows = self.connection.execute("SELECT id FROM packs").fetchall()
+        return iter([row[0] for row in rows])
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM packs").fetchone()[0]
+
+    def expired(self, before, limit=-1):
+        """
+        Args:
+            before (float): Time before which the last download of a pack is too old
+            limit (int): Most ids returned, -1 for all of them
+
+        Returns:
+            list: Ids of the packs last downloaded before that time, the oldest first
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id FROM packs WHERE last_download < ? ORDER BY last_download LIMIT ?", (before, limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def oldest(self, limit):
+        """
+        Returns:
+            list: (id, size) of the limit packs downloaded the longest time ago, the oldest first
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT id, size FROM packs ORDER BY last_download LIMIT ?", (limit,)
+            ).fetchall()
+
+    def sizes(self):
+        """
+        Returns:
+            dict: Id of every pack to its size
+        """
+        with self.lock:
+            return dict(self.connection.execute("SELECT id, size FROM packs").fetchall())
+
+    def total_size(self):
+        with self.lock:
+            return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM packs").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,95 @@
+import functools
+import ipaddress
+import re
+
+# What check_agent decides for a User-Agent
+KNOWN = "known"
+UNKNOWN = "unknown"
+REJECTED = "rejected"
+
+
+def compile_agents(patterns):
+    """One regex matching what any of the patterns fully matches, None if there are none."""
+    if not patterns:
+        return None
+    return re.compile("|".join("(?:" + pattern + ")" for pattern in patterns), flags=re.IGNORECASE)
+
+
+def parse_networks(networks):
+    # a single address is a network of one address
+    return tuple(ipaddress.ip_network(network, strict=False) for network in networks)
+
+
+class AccessPolicy:
+    """
+    The [security] section of the settings compiled once: one regex per route
+    for the known User-Agents, with the decisions of the recent User-Agents
+    cached, the keys of the key filter in a set and the allowed and denied
+    IP networks parsed.
+
+    Args:
+        config (dict): The settings
+    """
+
+    def __init__(self, config):
+        security = config["security"]
+        self.block_unknown_agents = security["block_unknown_agents"]
+        self.reject = {"upload": security["reject_upload"], "download": security["reject_download"]}
+        self.agent_checks = {}
+        for route in ("upload", "download"):
+            agents = compile_agents(security["known_agents"][route])
+            # clients send the same few User-Agents over and over
+            self.agent_checks[route] = functools.lru_cache(maxsize=1024)(
+                lambda user_agent, agents=agents: agents is not None and agents.fullmatch(user_agent) is not None
+            )
+        self.whitelist = security["key_filter"]["mode"] == "whitelist"
+        self.keys = frozenset(security["key_filter"]["keys"])
+        self.allowed_ips = parse_networks(security["allowed_ips"])
+        self.denied_ips = parse_networks(security["denied_ips"])
+        self.ip_header = config["nginx"]["ip_header"] if config["nginx"]["enabled"] else None
+
+    def real_ip(self, request):
+        """
+        Returns:
+            str: The IP of the client, from the header set by the reverse proxy if there is one
+        """
+        if self.ip_header is None:
+            return request.remote or ""
+        return request.headers.get(self.ip_header, "")
+
+    def check_agent(self, route, user_agent):
+        """
+        Args:
+            route (str): "upload" or "download"
+            user_agent (str): The User-Agent header, None if it is missing
+
+        Returns:
+            str: KNOWN, UNKNOWN if the request is let through anyway, or REJECTED
+        """
+        if self.agent_checks[route](user_agent or ""):
+            return KNOWN
+        if self.block_unknown_agents and self.reject[route]:
+            return REJECTED
+        return UNKNOWN
+
+    def allows_key(self, key_id):
+        # whitelist: only the keys of the list, blacklist: every key but them
+        return (key_id in self.keys) == self.whitelist
+
+    def allows_ip(self, ip):
+        """
+        An IP is allowed if it is in none of the denied networks and, when
+        there are allowed networks, in one of them. An IP that can't be
+        parsed is only allowed when neither list is used.
+        """
+        if not self.allowed_ips and not self.denied_ips:
+            return True
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        if any(address in network for network in self.denied_ips):
+            return False
+        return not self.allowed_ips or any(address in network for network in self.allowed_ips)
@@ -1,26 +1,94 @@
+import asyncio
 import logging
-import re
+import math
 
 from aiohttp import web
 from datetime import datetime
 from colorama import Fore,init
+from polymath import limits, security, uploads, workers
 init()
 
+# Packs are named after the SHA1 of their content, a pack url always serves the same bytes
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
 def setup(app, config, packs_manager):
     routes = Routes(config, packs_manager)
     app.add_routes(
         [
             web.post("/upload", routes.upload),
             web.get("/pack.zip", routes.download),
+            web.get("/pack.json", routes.metadata),
             web.get("/debug", routes.debug),
+            web.get("/stats", routes.stats),
         ]
     )
+    app.on_response_prepare.append(keep_pack_etag)
+
+
+def etag_matches(if_none_match, id_hash):
+    """
+    Args:
+        if_none_match (str): The If-None-Match header, or None
+        id_hash (str): The id of the pack, which is its ETag
+
+    Returns:
+        bool: Whether the client already has the pack
+    """
+    if if_none_match is None:
+        return False
+    for etag in if_none_match.split(","):
+        etag = etag.strip()
+        # If-None-Match uses the weak comparison
+        if etag.startswith("W/"):
+            etag = etag[2:]
+        if etag == "*" or etag == '"' + id_hash + '"':
+            return True
+    return False
+
+
+def pack_headers(id_hash):
+    return {"ETag": '"' + id_hash + '"', "Cache-Control": IMMUTABLE}
+
+
+class PackFileResponse(web.FileResponse):
+    """
+    Sends a pack too big for the hot cache with sendfile, with Range support,
+    under the id of the pack as ETag, see keep_pack_etag.
+
+    Args:
+        path (str): The pack file
+        id_hash (str): The id of the pack
+    """
+
+    def __init__(self, path, id_hash):
+        super().__init__(path, headers=pack_headers(id_hash))
+        self.content_type = "application/zip"
+        self.id_hash = id_hash
+
+
+async def keep_pack_etag(request, response):
+    """
+    FileResponse replaces the ETag with one made of the mtime and the size
+    while it is prepared, the id of the pack is put back once the headers
+    of a PackFileResponse are set, before they are sent.
+    """
+    if not isinstance(response, PackFileResponse):
+        return
+    if response.status < 400:
+        response.etag = response.id_hash
+    else:
+        # 404 if the cleaner removed the pack since it was looked up, it must not be cached
+        response.headers.pop("Cache-Control", None)
+        response.headers.pop("ETag", None)
 
 
 class Routes:
     def __init__(self, config, packs_manager):
         self.config = config
         self.packs = packs_manager
+        self.policy = security.AccessPolicy(config)
+        self.limits = limits.UploadLimits(config["limits"])
 
     def start(self):
         web.run_app(self.app)
@@ -33,68 +101,126 @@ class Routes:
     
     async def upload(self, request):
         # set the IP depending on the enviroment.        
-        Real_IP = request.headers[ self.config['nginx']['ip_header'] ] if self.config["nginx"]["enabled"] else request.remote
+        Real_IP = self.policy.real_ip(request)
         logging.info("Received Upload request from: "+Real_IP)
-        
-        User_Agent = request.headers['User-Agent'] 
-        print(User_Agent)
-        if not any( [re.compile(x,flags=re.IGNORECASE).fullmatch(User_Agent) for x in self.config['security']['known_agents']['upload']] ):
-            if self.config['security']['block_unknown_agents'] and self.config['security']['reject_upload']:
-                logging.error("Rejecting Upload: "+User_Agent+" from "+Real_IP)
-                return web.json_response({"error": "Unknown Application"}) 
-            else:
-                logging.warn("Unknown Application access: "+User_Agent+" from "+Real_IP)
+        if not self.policy.allows_ip(Real_IP):
+            logging.error("Rejecting Upload: denied IP "+Real_IP)
+            self.limits.reject("ip")
+            return web.json_response({"error": "Access denied."}, status=403)
+
+        User_Agent = request.headers.get('User-Agent', "")
+        logging.debug("Upload User-Agent: "+User_Agent)
+        agent = self.policy.check_agent("upload", User_Agent)
+        if agent == security.REJECTED:
+            logging.error("Rejecting Upload: "+User_Agent+" from "+Real_IP)
+            self.limits.reject("agent")
+            return web.json_response({"error": "Unknown Application"}) 
+        elif agent == security.UNKNOWN:
+            logging.warn("Unknown Application access: "+User_Agent+" from "+Real_IP)
         
         """
         Allow to upload a resourcepack with a spigot id
 
            Test: curl -F "pack=@./file.zip" -F "id=EXAMPLE" -X POST http://localhost:8080/upload
+             or: curl --data-binary "@./file.zip" -H "Content-Type: application/zip" -X POST "http://localhost:8080/upload?id=EXAMPLE"
 
            Parameters:
                self (Routes): An instance of Routes
                request (aiohttp.web_request.Request): The web request
 
            Returns:
-               pack (web.json_response): Pack url and its SHA1 hash
+               pack (web.json_response): Pack url, its SHA1 hash and the bytes saved by deduplication,
+                                         503 when the server is busy, 429 when the key or IP uploads too often
         """
-        data = await request.post()
-        key_id = data["id"]
+        # rejected before the pack is received, it can be 100 MB
+        if self.limits.full() or (self.packs.workers is not None and self.packs.workers.full()):
+            logging.warning("Rejecting Upload: server is busy, from "+Real_IP)
+            return self.busy()
+        wait = self.limits.ips.take(Real_IP)
+        if wait:
+            logging.warning("Rejecting Upload: too many uploads from "+Real_IP)
+            self.limits.reject("ip_rate")
+            return self.too_many(wait)
 
-        key_filter_config = self.config['security']['key_filter']
-        key_filter_whitelist = key_filter_config['mode'] == 'whitelist'
-        key_filter = key_filter_config['keys']
+        self.limits.in_flight += 1
+        try:
+            return await self.receive_upload(request, Real_IP)
+        finally:
+            self.limits.in_flight -= 1
 
-        if key_filter_whitelist:
-            if key_id not in key_filter:
-                logging.error("Rejecting Upload: "+key_id+" from "+Real_IP)
-                return web.json_response({"error": "This license is not valid."})
-        else:
-            if key_id in key_filter:
+    async def receive_upload(self, request, Real_IP):
+        """Receives the pack of an admitted upload, checks its key and converts it."""
+        key_id, spool = await uploads.receive_pack(request, self.packs.uploads_folder, self.config["request"]["max_size"])
+        try:
+            if key_id is None or spool is None:
+                logging.error("Rejecting Upload: missing pack or id from "+Real_IP)
+                return web.json_response({"error": "Missing pack or id."})
+            logging.debug("Received pack "+spool.digest+" ("+str(spool.size)+" bytes) from "+Real_IP)
+
+            if not self.policy.allows_key(key_id):
                 logging.error("Rejecting Upload: "+key_id+" from "+Real_IP)
+                self.limits.reject("key")
                 return web.json_response({"error": "This license is not valid."})
+            wait = self.limits.keys.take(key_id)
+            if wait:
+                logging.warning("Rejecting Upload: too many uploads for "+key_id+" from "+Real_IP)
+                self.limits.reject("key_rate")
+                return self.too_many(wait)
 
-        pack = data["pack"].file.read()
-        id_hash = self.packs.register(pack, key_id, Real_IP) # use the above header if behind e.x.: nginx
+            try:
+                id_hash, _ = await self.packs.register_async(spool.path, key_id, Real_IP, spool.digest) # use the above header if behind e.x.: nginx
+            except workers.PoolFullError:
+                logging.warning("Rejecting Upload: conversion queue is full, from "+Real_IP)
+                return self.busy()
+            except asyncio.TimeoutError:
+                logging.error("Pack conversion timed out for "+key_id+" from "+Real_IP)
+                return web.json_response({"error": "Pack conversion timed out."})
+            except workers.WorkerError as e:
+                logging.error("Pack conversion failed for "+key_id+" from "+Real_IP+":\n"+str(e))
+                return web.json_response({"error": "Pack conversion failed."})
+        finally:
+            if spool is not None:
+                spool.remove()
 
         return web.json_response(
             {
                 "url": self.config["server"]["url"] + "/pack.zip?id=" + id_hash,
                 "sha1": id_hash,
+                # bytes of identical files stored once in the pack
+                "deduplicated": self.packs.registry[id_hash]["deduplicated"],
             }
         )
 
+    def busy(self):
+        self.limits.reject("busy")
+        return web.json_response(
+            {"error": "Server is busy, try again later."},
+            status=503,
+            headers={"Retry-After": str(self.limits.retry_after)},
+        )
+
+    def too_many(self, wait):
+        return web.json_response(
+            {"error": "Too many uploads, try again later."},
+            status=429,
+            headers={"Retry-After": str(math.ceil(wait))},
+        )
+
     # To download a resourcepack from its id
     async def download(self, request):
         logging.debug("Received User Download request.")
         
-        Real_IP = request.headers[ self.config['nginx']['ip_header'] ] if self.config["nginx"]["enabled"] else request.remote
-        User_Agent = request.headers['User-Agent'] 
-        if not any( [re.compile(x,flags=re.IGNORECASE).fullmatch(User_Agent) for x in self.config['security']['known_agents']['download']] ):
-            if self.config['security']['block_unknown_agents'] and self.config['security']['reject_download']:
-                logging.error("Rejecting Upload: "+User_Agent+" from "+Real_IP)
-                return web.json_response({"error": "Unknown Application"}) 
-            else:
-                logging.warn("Unknown Application access: "+User_Agent+" from "+Real_IP)
+        Real_IP = self.policy.real_ip(request)
+        if not self.policy.allows_ip(Real_IP):
+            logging.error("Rejecting Download: denied IP "+Real_IP)
+            return web.json_response({"error": "Access denied."}, status=403)
+        User_Agent = request.headers.get('User-Agent', "")
+        agent = self.policy.check_agent("download", User_Agent)
+        if agent == security.REJECTED:
+            logging.error("Rejecting Download: "+User_Agent+" from "+Real_IP)
+            return web.json_response({"error": "Unknown Application"}) 
+        elif agent == security.UNKNOWN:
+            logging.warn("Unknown Application access: "+User_Agent+" from "+Real_IP)
                 
         """
         Allow to download a resourcepack with a spigot id
@@ -106,18 +232,64 @@ class Routes:
                 request (aiohttp.web_request.Request): The web request
 
             Returns:
-                pack (web.FileResponse): the resource pack
+                pack (web.Response): the resource pack, from memory if it is one of the most downloaded,
+                                     304 if the client already has it, only the headers for HEAD
         """
         params = request.rel_url.query
+        id_hash = params["id"]
         try:
-            pack = self.packs.fetch(params["id"])
+            if request.method == "HEAD":
+                # answered from the registry, it isn't a download
+                info = self.packs.info(id_hash)
+                if info is None:
+                    return web.Response(status=404)
+                headers = pack_headers(id_hash)
+                headers["Content-Length"] = str(info["size"])
+                return web.Response(headers=headers, content_type="application/zip")
+
+            info = self.packs.info(id_hash)
+            pack = self.packs.fetch(id_hash) if info is not None else None
             if not pack:
-                return web.Response(body=b"Pack not found")
-            else:
-                return web.FileResponse(pack, headers={"content-type": "application/zip"})
+                return web.Response(body=b"Pack not found", status=404)
+            headers = pack_headers(id_hash)
+            if etag_matches(request.headers.get("If-None-Match"), id_hash):
+                return web.Response(status=304, headers=headers)
+            try:
+                if self.packs.hot_packs.fits(info["size"]):
+                    data = await self.packs.hot_packs.load(id_hash, pack)
+                    return web.Response(body=data, headers=headers, content_type="application/zip")
+                else:
+                    return PackFileResponse(pack, id_hash)
+            except FileNotFoundError:
+                # removed by the cleaner since it was looked up
+                return web.Response(body=b"Pack not found", status=404)
         except TimeoutError:
             logging.warn("Download Request timed out!")
             
+    async def metadata(self, request):
+        """
+        Url, SHA1 and size of a pack, from the registry without opening the pack
+
+            Test: curl http://localhost:8080/pack.json?id=EXAMPLE
+
+            Parameters:
+                self (Routes): An instance of Routes
+                request (aiohttp.web_request.Request): The web request
+        """
+        id_hash = request.rel_url.query.get("id", "")
+        info = self.packs.info(id_hash)
+        if info is None:
+            return web.json_response({"error": "Pack not found"}, status=404)
+        return web.json_response(
+            {
+                "url": self.config["server"]["url"] + "/pack.zip?id=" + id_hash,
+                "sha1": id_hash,
+                "size": info["size"],
+                "deduplicated": info.get("deduplicated", 0),
+            },
+            headers=pack_headers(id_hash),
+        )
+
     async def debug(self, request):
         logging.warning(str(type(request)))
         """
@@ -130,3 +302,25 @@ class Routes:
                 request (aiohttp.web_request.Request): The web request
         """
         return web.Response(body="It seems to be working...")
+
+    async def stats(self, request):
+        """
+        Counters of the server, for the clients allowed to upload
+
+            Test: curl http://localhost:8080/stats?id=EXAMPLE
+
+            Parameters:
+                self (Routes): An instance of Routes
+                request (aiohttp.web_request.Request): The web request
+        """
+        Real_IP = self.policy.real_ip(request)
+        key_id = request.rel_url.query.get("id", "")
+        if (
+            not self.policy.allows_ip(Real_IP)
+            or self.policy.check_agent("upload", request.headers.get("User-Agent", "")) == security.REJECTED
+            or not key_id
+            or not self.policy.allows_key(key_id)
+        ):
+            logging.warning("Rejecting Stats request from "+Real_IP)
+            return web.json_response({"error": "Access denied."}, status=403)
+        return web.json_response({"hot_packs": self.packs.hot_packs.stats(), "uploads": self.limits.stats()})
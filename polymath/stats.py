@@ -0,0 +1,86 @@
+import contextlib
+import logging
+import time
+
+
+class Stage:
+    """
+    Measures of one stage of the conversion pipeline.
+
+    Args:
+        name (str): Name of the stage
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        # bytes_in, bytes_out, entries... only what the stage could measure
+        self.counters = {}
+
+    def count(self, counter, value):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def __str__(self):
+        counters = "".join(", %s=%d" % item for item in self.counters.items())
+        return "%s: %.3fs wall, %.3fs cpu%s" % (self.name, self.wall, self.cpu, counters)
+
+
+class PipelineStats:
+    """
+    Wall time, CPU time and counters of each stage of a conversion. Built in
+    the worker process and sent back with the pack, so it is logged by the
+    process that handled the upload.
+
+    CPU time is the one of the process running the stage, including its
+    threads but not the processes of the JSON conversion pool.
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measures the with block as a stage, yields its Stage to count things on."""
+        stage = Stage(name)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield stage
+        finally:
+            stage.wall = time.perf_counter() - wall
+            stage.cpu = time.process_time() - cpu
+            self.stages.append(stage)
+
+    def wall(self):
+        return sum(stage.wall for stage in self.stages)
+
+    def cpu(self):
+        return sum(stage.cpu for stage in self.stages)
+
+    def counter(self, counter):
+        """Sum of a counter over every stage."""
+        return sum(stage.counters.get(counter, 0) for stage in self.stages)
+
+    def summary(self):
+        """
+        One line with the size of the upload, the size and the entries of the
+        converted pack and the time of every stage.
+        """
+        first = self.stages[0].counters if self.stages else {}
+        last = self.stages[-1].counters if self.stages else {}
+        stages = ", ".join("%s %.3fs" % (stage.name, stage.wall) for stage in self.stages)
+        return "%d -> %d bytes, %d entries, %.3fs wall (%s), %.3fs cpu" % (
+            first.get("bytes_in", 0), last.get("bytes_out", 0), last.get("entries", 0),
+            self.wall(), stages, self.cpu(),
+        )
+
+    def log(self, prefix, level=logging.INFO, stages_level=logging.DEBUG):
+        """
+        Args:
+            prefix (str): Start of every line, e.g. which pack it is about
+            level (int): Logging level of the summary line
+            stages_level (int): Logging level of the line of each stage
+        """
+        for stage in self.stages:
+            logging.log(stages_level, prefix + str(stage))
+        logging.log(level, prefix + self.summary())
@@ -0,0 +1,97 @@
+import hashlib
+import os
+import tempfile
+
+from aiohttp import web
+
+CHUNK_SIZE = 1 << 16
+
+
+class SpooledPack:
+    """
+    An uploaded pack written to a temporary file while it is received.
+
+    Args:
+        folder (str): Folder the temporary file is created in
+        max_size (int): Uploads bigger than that are rejected
+    """
+
+    def __init__(self, folder, max_size):
+        fd, self.path = tempfile.mkstemp(dir=folder, prefix="upload-")
+        self.file = os.fdopen(fd, "wb")
+        self.max_size = max_size
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise web.HTTPRequestEntityTooLarge(max_size=self.max_size, actual_size=self.size)
+        self.file.write(chunk)
+        self.sha256.update(chunk)
+
+    async def write_from(self, read_chunk):
+        while True:
+            chunk = await read_chunk(CHUNK_SIZE)
+            if not chunk:
+                break
+            self.write(chunk)
+        self.file.close()
+
+    @property
+    def digest(self):
+        return self.sha256.hexdigest()
+
+    def remove(self):
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+async def receive_pack(request, folder, max_size):
+    """
+    Spools the pack of an upload request to disk, without holding it in memory.
+
+    The pack is either the "pack" field of a multipart form with the key in
+    its "id" field, or the raw body of an application/zip request with the
+    key in the "id" query parameter.
+
+    Args:
+        request (aiohttp.web_request.Request): The web request
+        folder (str): Folder the pack is spooled to
+        max_size (int): Maximum size of the pack
+
+    Returns:
+        tuple: (key id or None, SpooledPack or None)
+    """
+    if request.content_type == "application/zip":
+        spool = SpooledPack(folder, max_size)
+        try:
+            await spool.write_from(request.content.read)
+        except BaseException:
+            spool.remove()
+            raise
+        return request.rel_url.query.get("id"), spool
+
+    key_id, spool = None, None
+    if not request.content_type.startswith("multipart/"):
+        return key_id, spool
+
+    try:
+        reader = await request.multipart()
+        while True:
+            part = await reader.next()
+            if part is None:
+                break
+            if part.name == "id":
+                key_id = await part.text()
+            elif part.name == "pack" and spool is None:
+                spool = SpooledPack(folder, max_size)
+                await spool.write_from(part.read_chunk)
+            else:
+                await part.release()
+    except BaseException:
+        if spool is not None:
+            spool.remove()
+        raise
+    return key_id, spool
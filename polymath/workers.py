@@ -0,0 +1,195 @@
+import asyncio
+import atexit
+import importlib
+import logging
+import multiprocessing
+import signal
+import sys
+import traceback
+
+
+class PoolFullError(Exception):
+    """Raised when the wait queue of the worker pool is full."""
+
+
+class WorkerError(Exception):
+    """Raised when a job failed or its worker process died."""
+
+
+def _worker_main(conn, modules):
+    # exit cleanly when terminated, so the processes a job started are stopped too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+    # import the heavy modules before the first job comes in
+    for module in modules:
+        importlib.import_module(module)
+
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            break  # the server went away
+        if job is None:
+            break  # asked to stop
+        func, args = job
+
+        try:
+            result = (True, func(*args))
+        except Exception:
+            result = (False, traceback.format_exc())
+        conn.send(result)
+
+
+class Worker:
+    def __init__(self, context, modules):
+        self.conn, child_conn = context.Pipe()
+        # not a daemon so jobs can still use process pools of their own,
+        # the worker exits by itself once its pipe is closed
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, modules), daemon=False
+        )
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        # workers forked later hold a copy of this end of the pipe, closing
+        # it isn't enough for the worker to see EOF
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass  # already gone
+        self.conn.close()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.kill()
+
+
+class WorkerPool:
+    """
+    Runs jobs in warm worker processes, so they don't block the event loop.
+
+    Args:
+        config (dict): The [workers] section of the settings.
+        modules (tuple): Modules every worker imports before its first job.
+    """
+
+    def __init__(self, config, modules=()):
+        self.processes = config["processes"]
+        self.queue_size = config["queue_size"]
+        self.timeout = config["timeout"]
+        self.modules = tuple(modules)
+        # forked workers don't import the entry script again, where fork is
+        # missing the run and bulk scripts guard their startup with __main__
+        if "fork" in multiprocessing.get_all_start_methods():
+            self.context = multiprocessing.get_context("fork")
+        else:
+            self.context = multiprocessing.get_context()
+        self.idle = [Worker(self.context, self.modules) for _ in range(self.processes)]
+        self.slots = None
+        self.waiting = 0
+        # kept referenced, the loop only holds weak references to tasks
+        self.replacing = set()
+        # workers aren't daemons, they would keep the interpreter from exiting
+        atexit.register(self.shutdown)
+
+    def full(self):
+        """Whether a job run now would be rejected with PoolFullError."""
+        return self.slots is not None and self.slots.locked() and self.waiting >= self.queue_size
+
+    async def run(self, func, *args):
+        """
+        Run func(*args) in a worker process.
+
+        Raises:
+            PoolFullError: If too many jobs are already waiting.
+            asyncio.TimeoutError: If the job ran longer than the timeout, its worker is killed.
+            WorkerError: If the job raised or the worker died.
+        """
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.processes)
+
+        if self.slots.locked():
+            if self.waiting >= self.queue_size:
+                raise PoolFullError()
+            self.waiting += 1
+            try:
+                await self.slots.acquire()
+            finally:
+                self.waiting -= 1
+        else:
+            await self.slots.acquire()
+
+        worker = self.idle.pop()
+        try:
+            result = await self._run_on(worker, func, args)
+        except BaseException:
+            # the worker may still be busy or broken, never reuse it, its
+            # slot is released once it is replaced
+            task = asyncio.get_running_loop().create_task(self._replace(worker))
+            self.replacing.add(task)
+            task.add_done_callback(self.replacing.discard)
+            raise
+        self.idle.append(worker)
+        self.slots.release()
+
+        success, value = result
+        if not success:
+            raise WorkerError(value)
+        return value
+
+    async def _replace(self, worker):
+        # on the executor, a job stuck in C code only sees SIGTERM once the call returns
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, worker.kill)
+        finally:
+            self.idle.append(Worker(self.context, self.modules))
+            self.slots.release()
+
+    async def _run_on(self, worker, func, args):
+        loop = asyncio.get_running_loop()
+        # a pack can be large, don't block the loop while it is sent
+        await loop.run_in_executor(None, worker.conn.send, (func, args))
+        try:
+            await self._wait_result(worker)
+        except asyncio.TimeoutError:
+            logging.error("Job " + func.__name__ + " timed out, killing its worker.")
+            raise
+        try:
+            return worker.conn.recv()
+        except EOFError:
+            raise WorkerError("worker process died while running " + func.__name__)
+
+    async def _wait_result(self, worker):
+        """
+        Waits until the result of the job of a worker can be received.
+
+        Raises:
+            asyncio.TimeoutError: If the job runs longer than the timeout.
+        """
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        try:
+            # waited for on the loop, an executor thread would be held for the whole job
+            loop.add_reader(worker.conn.fileno(), lambda: readable.done() or readable.set_result(None))
+        except NotImplementedError:
+            # the proactor loop of Windows can't watch pipes, a thread polls it instead
+            if not await loop.run_in_executor(None, worker.conn.poll, self.timeout):
+                raise asyncio.TimeoutError()
+            return
+        try:
+            await asyncio.wait_for(readable, self.timeout)
+        finally:
+            loop.remove_reader(worker.conn.fileno())
+
+    def shutdown(self):
+        for worker in self.idle:
+            worker.stop()
+        self.idle = []
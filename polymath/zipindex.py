@@ -0,0 +1,102 @@
+import struct
+from array import array
+
+EOCD_SIGNATURE = b'PK\x05\x06'
+CENTRAL_DIR_SIGNATURE = 0x02014B50
+
+# Central directory file header, from the compression method to the local header offset
+CENTRAL_DIR_HEADER = struct.Struct('<I6xH4xIIIHHH8xI')
+LOCAL_HEADER_NAMES = struct.Struct('<HH')
+
+
+def find_eocd(data):
+    """
+    Finds the End of Central Directory (EOCD) record.
+
+    Args:
+        data (bytes-like): The zip file, anything with rfind (bytes, mmap...)
+
+    Returns:
+        int: Offset of the EOCD record
+    """
+    # Try the simplest case first: no comment, EOCD is at the last 22 bytes
+    if len(data) >= 22 and data[-22:-18] == EOCD_SIGNATURE:
+        return len(data) - 22
+
+    # Search the last ~64KB for the EOCD signature
+    search_start = max(0, len(data) - 65536 - 22) + 1
+    end = len(data)
+    while True:
+        i = data.rfind(EOCD_SIGNATURE, search_start, end)
+        if i < 0:
+            raise ValueError("Could not find EOCD in the ZIP file")
+        # Verify this is a valid EOCD, the central directory is either where it says
+        # or right before the EOCD when the offsets of the archive are shifted
+        if i + 20 <= len(data):
+            cd_len, cd_offset = struct.unpack_from('<II', data, i + 12)
+            for offset in (cd_offset, i - cd_len):
+                if 0 <= offset < len(data) and data[offset:offset + 4] == b'PK\x01\x02':
+                    return i
+        end = i + 3
+
+
+class ZipIndex:
+    """
+    Central directory of a (possibly damaged) zip buffer, read once into arrays.
+    Nothing is copied out of the buffer, data() returns memoryviews into it.
+
+    Offsets recorded in the central directory are shifted when the archive
+    doesn't start where the central directory says, like the mangled packs do.
+
+    Args:
+        data (bytes-like): The zip file
+    """
+
+    def __init__(self, data):
+        self.view = memoryview(data)
+        self.eocd_offset = find_eocd(data)
+        central_dir_len, self.central_dir_offset = struct.unpack_from('<II', self.view, self.eocd_offset + 12)
+
+        self.names = []
+        self.methods = array('H')
+        self.crcs = array('I')
+        self.compressed_sizes = array('I')
+        self.uncompressed_sizes = array('I')
+        self.data_offsets = array('Q')
+
+        pointer = self.eocd_offset - central_dir_len
+        shdiff = self.central_dir_offset - pointer
+
+        while pointer + CENTRAL_DIR_HEADER.size <= self.eocd_offset:
+            (signature, method, crc, compressed_size, uncompressed_size,
+             filename_length, extra_field_length, file_comment_length,
+             file_pointer) = CENTRAL_DIR_HEADER.unpack_from(self.view, pointer)
+            if signature != CENTRAL_DIR_SIGNATURE:
+                break
+            pointer += CENTRAL_DIR_HEADER.size
+            name = bytes(self.view[pointer:pointer + filename_length]).decode('utf-8', errors='replace')
+            pointer += filename_length + extra_field_length + file_comment_length
+
+            # Skip the local file header, its name and extra field may differ from the central directory
+            file_pointer -= shdiff
+            lfh_filename_len, lfh_extra_field_len = LOCAL_HEADER_NAMES.unpack_from(self.view, file_pointer + 26)
+
+            self.names.append(name)
+            self.methods.append(method)
+            self.crcs.append(crc)
+            self.compressed_sizes.append(compressed_size)
+            self.uncompressed_sizes.append(uncompressed_size)
+            self.data_offsets.append(file_pointer + 30 + lfh_filename_len + lfh_extra_field_len)
+
+    def __len__(self):
+        return len(self.names)
+
+    def data(self, i):
+        """Compressed data of the i-th entry, as a memoryview."""
+        offset = self.data_offsets[i]
+        return self.view[offset:offset + self.compressed_sizes[i]]
+
+    def __iter__(self):
+        """Yields (file name, compression method, compressed data) for every entry."""
+        for i in range(len(self.names)):
+            yield self.names[i], self.methods[i], self.data(i)
@@ -0,0 +1,130 @@
+"""
+Corpus test of the single pass model classification: on a seeded corpus of
+random item models, ModelKind must agree with the is_*_model helpers of the
+converter, and convert_json_format must give byte-identical output whether
+it classifies models with ModelKind or with the helpers.
+
+    python -m pytest tests
+"""
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from polymath import converter  # noqa: E402
+
+CORPUS_SIZE = 40000
+
+NAMES = sorted(converter.HEAD_MODELS) + sorted(converter.POTION_MODELS) + sorted(converter.CHEST_MODELS) + [
+    "shield.json", "fishing_rod.json", "bow.json", "crossbow.json", "Bow.JSON", "PLAYER_HEAD.json",
+    "diamond_sword.json", "paper.json", "stick.json", "bow", "crossbow.txt", "",
+]
+PREDICATES = ["custom_model_data", "damaged", "damage", "blocking", "cast", "pulling", "pull", "charged", "firework"]
+TEXTURES = [
+    "item/a", "minecraft:item/b", "c", "item/crossbow_standby",
+    "item/splash_potion_overlay", "item/lingering_potion_overlay", "",
+]
+PARENTS = ["item/generated", "builtin/entity", "item/handheld_rod", "item/handheld", ""]
+MODELS = ["item/x", "minecraft:item/y", "ns:z/w", "q"]
+
+
+def random_predicate(rng):
+    if rng.random() < 0.01:
+        # malformed predicates
+        return rng.choice([None, 5, "cast damaged", ["damage", "damaged"]])
+    predicate = {}
+    for key in PREDICATES:
+        if rng.random() < 0.3:
+            predicate[key] = rng.choice([0, 1, rng.randrange(1, 5), 0.5])
+    if rng.random() < 0.7:
+        predicate["custom_model_data"] = rng.randrange(1, 6)
+    return predicate
+
+
+def random_model(rng):
+    model = {}
+    if rng.random() < 0.8:
+        model["textures"] = {"layer0": rng.choice(TEXTURES)}
+    if rng.random() < 0.6:
+        model["parent"] = rng.choice(PARENTS)
+    if rng.random() < 0.3:
+        model["display"] = {"head": {"scale": [1, 1, 1]}}
+    if rng.random() < 0.95:
+        overrides = []
+        for _ in range(rng.randrange(0, 8)):
+            override = {"predicate": random_predicate(rng), "model": rng.choice(MODELS)}
+            if rng.random() < 0.02:
+                override = rng.choice(["s", 3, {"model": "m"}])
+            elif rng.random() < 0.02:
+                del override["model"]
+            overrides.append(override)
+        model["overrides"] = overrides
+    return model
+
+
+def corpus():
+    """(model, is_item_model, file_path) of the corpus, the same every run."""
+    rng = random.Random(1)
+    for _ in range(CORPUS_SIZE):
+        model = random_model(rng)
+        file_path = "assets/minecraft/models/item/" + rng.choice(NAMES)
+        yield model, rng.random() < 0.1, file_path
+
+
+class HelperKind:
+    """ModelKind worked out with the is_*_model helpers, each of them looks at the model again."""
+
+    def __init__(self, json_data, file_path=""):
+        is_head, head_kind, head_base = converter.is_head_model(json_data, file_path)
+        self.head = (head_kind, head_base) if is_head else None
+        is_chest, chest_type = converter.is_chest_model(json_data, file_path)
+        self.chest = chest_type if is_chest else None
+        self.potion = converter.is_potion_model(json_data, file_path)
+        self.shield = converter.is_shield_model(json_data, file_path)
+        self.fishing_rod = converter.is_fishing_rod_model(json_data, file_path)
+        filename_without_ext = os.path.splitext(os.path.basename(file_path).lower())[0]
+        self.bow = filename_without_ext == "bow"
+        self.crossbow = filename_without_ext == "crossbow"
+        self.mixed_damage = converter.has_mixed_custom_damage(json_data)
+        self.damage = converter.is_damage_model(json_data)
+
+
+def classify(kind_class, model, file_path):
+    """The fields of the kind of the model, or None if classifying it raises."""
+    try:
+        kind = kind_class(model, file_path)
+    except Exception:
+        return None
+    return {field: getattr(kind, field) for field in converter.ModelKind.__slots__}
+
+
+def convert(model, is_item_model, file_path):
+    """The converted model as written to the pack, or None if the conversion raises."""
+    try:
+        # a fresh copy, the conversion may change its input
+        converted = converter.convert_json_format(json.loads(json.dumps(model)), is_item_model, file_path)
+    except Exception:
+        return None
+    return json.dumps(converted, indent=4)
+
+
+def test_model_kind_matches_helpers():
+    mismatches = []
+    for model, _, file_path in corpus():
+        expected = classify(HelperKind, model, file_path)
+        actual = classify(converter.ModelKind, model, file_path)
+        # a malformed override can stop one of them before the other
+        if expected is not None and actual is not None and actual != expected:
+            mismatches.append((file_path, model, actual, expected))
+    assert not mismatches, "%d models classified differently, first: %r" % (len(mismatches), mismatches[0])
+
+
+def test_conversion_matches_helpers(monkeypatch):
+    converted = [convert(*item) for item in corpus()]
+    monkeypatch.setattr(converter, "ModelKind", HelperKind)
+    mismatches = [
+        item for item, actual in zip(corpus(), converted) if convert(*item) != actual
+    ]
+    assert not mismatches, "%d models converted differently, first: %r" % (len(mismatches), mismatches[0])